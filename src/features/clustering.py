@@ -1,12 +1,20 @@
-import pandas as pd
-from sklearn.cluster import KMeans
+from __future__ import annotations
+from typing import TYPE_CHECKING
+from src.lazy import lazy_import
+
+if TYPE_CHECKING:
+    from sklearn.cluster import KMeans
+
+pd = lazy_import("pandas")
+sklearn_cluster = lazy_import("sklearn.cluster")
 
 
 class Clustering:
 
-    def __init__(self, n_clusters: int = 3, random_state: int = 95):
+    def __init__(self, n_clusters: int = 3, random_state: int = 95, lean: bool = False):
         self.n_clusters = n_clusters
         self.random_state = random_state
+        self.lean = lean
         self.start_kmeans = self.end_kmeans = None
 
     def create_columns(
@@ -33,11 +41,14 @@ class Clustering:
     def predict(self, df: pd.DataFrame, column: str) -> pd.DataFrame:
         model = self.start_kmeans if column == "start" else self.end_kmeans
         coordinates = self.get_cordinates(column, df)
-        df[f"{column}_cluster"] = model.predict(coordinates)
+        clusters = model.predict(coordinates)
+        df[f"{column}_cluster"] = clusters.astype("uint8") if self.lean else clusters
         return df
 
     def fit(self, df: pd.DataFrame, column: str) -> KMeans:
-        kmeans = KMeans(n_clusters=self.n_clusters, random_state=self.random_state)
+        kmeans = sklearn_cluster.KMeans(
+            n_clusters=self.n_clusters, random_state=self.random_state
+        )
         coordinates = self.get_cordinates(column, df)
         kmeans.fit(coordinates)
         return kmeans
@@ -1,8 +1,14 @@
-import pandas as pd
+from __future__ import annotations
+from src.lazy import lazy_import
+
+pd = lazy_import("pandas")
 
 
 class Geographical:
 
+    def __init__(self, lean: bool = False):
+        self.lean = lean
+
     def create(self, df: pd.DataFrame) -> pd.DataFrame:
         geo_df = df.copy()
         geo_df["lat_diff"] = self.get_geografic_delta(geo_df, "lat")
@@ -12,4 +18,5 @@ class Geographical:
     def get_geografic_delta(
         self, geo_df: pd.DataFrame, coordinate_type: str
     ) -> pd.Series:
-        return geo_df[f"end_{coordinate_type}"] - geo_df[f"start_{coordinate_type}"]
+        delta = geo_df[f"end_{coordinate_type}"] - geo_df[f"start_{coordinate_type}"]
+        return delta.astype("float32") if self.lean else delta
@@ -1,8 +1,14 @@
-import pandas as pd
+from __future__ import annotations
+from src.lazy import lazy_import
+
+pd = lazy_import("pandas")
 
 
 class Interactions:
 
+    def __init__(self, lean: bool = False):
+        self.lean = lean
+
     def create(self, df: pd.DataFrame) -> pd.DataFrame:
         interaction_df = df.copy()
         interaction_df = self.add_same_cluster_features(interaction_df)
@@ -10,6 +16,9 @@ class Interactions:
         return interaction_df
 
     def add_same_cluster_features(self, df: pd.DataFrame):
-        df["is_same_cluster"] = (df["start_cluster"] == df["end_cluster"]).astype(int)
-        df["is_inter_cluster"] = (df["start_cluster"] != df["end_cluster"]).astype(int)
+        df["is_same_cluster"] = self.flag(df["start_cluster"] == df["end_cluster"])
+        df["is_inter_cluster"] = self.flag(df["start_cluster"] != df["end_cluster"])
         return df
+
+    def flag(self, mask: pd.Series) -> pd.Series:
+        return mask if self.lean else mask.astype(int)
@@ -1,4 +1,7 @@
-import pandas as pd
+from __future__ import annotations
+from src.lazy import lazy_import
+
+pd = lazy_import("pandas")
 
 
 class Temporal:
@@ -8,6 +11,9 @@ class Temporal:
     EVENING_RUSH_END = 19
     WEEKEND_DAY = 5
 
+    def __init__(self, lean: bool = False):
+        self.lean = lean
+
     def create(self, df: pd.DataFrame, rush_hours: bool = True) -> pd.DataFrame:
         time_df = df.copy()
         time_df["datetime"] = pd.to_datetime(time_df["datetime"])
@@ -30,28 +36,34 @@ class Temporal:
         return time_df
 
     def is_mourning_rush(self, time_df):
-        return (
+        return self.flag(
             (time_df["hour"] >= self.MORNING_RUSH_START)
             & (time_df["hour"] <= self.MORNING_RUSH_END)
-        ).astype(int)
+        )
 
     def is_evening_rush(self, time_df):
-        return (
+        return self.flag(
             (time_df["hour"] >= self.EVENING_RUSH_START)
             & (time_df["hour"] <= self.EVENING_RUSH_END)
-        ).astype(int)
+        )
 
     def is_rush_hour(self, time_df):
-        return (time_df["is_morning_rush"] | time_df["is_evening_rush"]).astype(int)
+        return self.flag(time_df["is_morning_rush"] | time_df["is_evening_rush"])
 
     def get_hour(self, time_df: pd.DataFrame) -> pd.Series:
-        return time_df["datetime"].dt.hour
+        return self.calendar_field(time_df["datetime"].dt.hour)
 
     def get_month(self, time_df: pd.DataFrame) -> pd.Series:
-        return time_df["datetime"].dt.month
+        return self.calendar_field(time_df["datetime"].dt.month)
 
     def get_day_of_week(self, time_df: pd.DataFrame) -> pd.Series:
-        return time_df["datetime"].dt.dayofweek
+        return self.calendar_field(time_df["datetime"].dt.dayofweek)
 
     def is_weekend(self, time_df: pd.DataFrame) -> pd.Series:
-        return (time_df["day_of_week"] >= self.WEEKEND_DAY).astype(int)
+        return self.flag(time_df["day_of_week"] >= self.WEEKEND_DAY)
+
+    def flag(self, mask: pd.Series) -> pd.Series:
+        return mask if self.lean else mask.astype(int)
+
+    def calendar_field(self, values: pd.Series) -> pd.Series:
+        return values.astype("uint8") if self.lean else values
@@ -0,0 +1,27 @@
+import importlib
+import sys
+import types
+
+
+# Stands in for a heavy dependency until one of its attributes is used.
+class LazyModule(types.ModuleType):
+    def __init__(self, name: str):
+        super().__init__(name)
+        self._module = None
+
+    def _load(self):
+        if self._module is None:
+            self._module = importlib.import_module(self.__name__)
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __dir__(self):
+        return dir(self._load())
+
+
+def lazy_import(name: str):
+    if name in sys.modules:
+        return sys.modules[name]
+    return LazyModule(name)
@@ -1,14 +1,19 @@
-import haversine as hs
-from src.predict.duration_preditcor import DurationPredictor
 import warnings
+from src.lazy import lazy_import
+from src.features import geodesic
+from src.predict.duration_preditcor import DurationPredictor
+
+np = lazy_import("numpy")
 
 warnings.filterwarnings("ignore")
 
 
 class AnomalyDetector:
-    def __init__(self, threshold=0.8):
+    def __init__(self, threshold=0.8, fast_distance=False, max_route_distance=0.5):
         self.duration_predictor = DurationPredictor()
         self.threshold = threshold
+        self.fast_distance = fast_distance
+        self.max_route_distance = max_route_distance
 
     def detect_time_anomalies(self, actual_duration, trip_data):
         start_lat = trip_data["start_lat"]
@@ -43,15 +48,39 @@ class AnomalyDetector:
             "deviation": deviation,
         }
 
-    def detect_route_anomalies(self, current_position, planned_route, max_distance=0.5):
-        min_distance = float("inf")
-        nearest_point = None
+    def classify_deviations(self, actual_durations, predicted_durations):
+        # Vectorized counterpart of detect_time_anomalies for bulk re-scoring.
+        # A missing actual or predicted duration leaves the row unscored: its
+        # deviation is NaN and it is never flagged.
+        actual = np.asarray(actual_durations, dtype=np.float64)
+        predicted = np.asarray(predicted_durations, dtype=np.float64)
+        unscored = np.isnan(actual) | np.isnan(predicted)
+        deviation = np.divide(
+            actual - predicted,
+            predicted,
+            out=np.where(unscored, np.nan, 0.0),
+            where=predicted > 0,
+        )
+        is_anomaly = np.abs(deviation) > self.threshold
+        anomaly_type = np.where(
+            is_anomaly, np.where(deviation > 0, "delay", "early"), None
+        )
+        return {
+            "deviation": deviation,
+            "is_anomaly": is_anomaly,
+            "anomaly_type": anomaly_type,
+        }
 
-        for point in planned_route["waypoints"]:
-            distance = hs.haversine(current_position, point)
-            if distance < min_distance:
-                min_distance = distance
-                nearest_point = point
+    def detect_route_anomalies(
+        self, current_position, planned_route, max_distance=None
+    ):
+        if max_distance is None:
+            max_distance = self.max_route_distance
+        waypoints = planned_route["waypoints"]
+        index, min_distance = geodesic.nearest(
+            current_position, waypoints, fast=self.fast_distance
+        )
+        nearest_point = waypoints[index]
 
         is_route_anomaly = min_distance > max_distance
 
@@ -0,0 +1,174 @@
+import os
+import threading
+
+
+class ShardedLock:
+    # One re-entrant lock per shard of vehicle ids: updates to different
+    # vehicles proceed in parallel while two updates to the same vehicle are
+    # serialized. Lock order is shard lock -> MatrixTrackingSystem.state_lock;
+    # no caller blocks on a second shard while holding one.
+    def __init__(self, num_shards=64):
+        self.locks = [threading.RLock() for _ in range(num_shards)]
+
+    def lock_for(self, key):
+        return self.locks[hash(key) % len(self.locks)]
+
+
+def stress_test(
+    num_vehicles=200,
+    pings_per_vehicle=50,
+    num_reads=2000,
+    stored_trips=50_000,
+    new_trips=200,
+    ingest_threads=2,
+    reader_threads=4,
+    seed=0,
+):
+    # Runs the same ingestion + read + store workload once on a single thread
+    # and once on a thread pool, and reports the combined operations per
+    # second. Routes are synthetic and never reach their destination, so no
+    # model is needed. The target workload is read-heavy: similar-trip scans
+    # over a large trip store run in NumPy kernels that release the GIL, so
+    # the pool can only gain when more than one CPU is available.
+    import time
+    from concurrent.futures import ThreadPoolExecutor
+    import numpy as np
+    import pandas as pd
+    from .system import MatrixTrackingSystem
+
+    rng = np.random.default_rng(seed)
+    departure = pd.Timestamp("2024-01-01 08:00")
+    starts = np.array([-23.55, -46.63]) + rng.normal(0, 0.05, (num_vehicles, 2))
+    ends = starts + 0.5
+    trip_times = [departure + pd.Timedelta(seconds=60 * i) for i in range(20)]
+    trips = [
+        [tuple(point) for point in start + rng.normal(0, 0.01, (20, 2)).cumsum(axis=0)]
+        for start in rng.choice(starts, new_trips)
+    ]
+    # The stored history is built as one frame; storing it trip by trip
+    # would dominate the setup.
+    history_starts = rng.choice(starts, stored_trips) + rng.normal(
+        0, 0.01, (stored_trips, 2)
+    )
+    history_ends = history_starts + rng.normal(0, 0.1, (stored_trips, 2))
+    durations = rng.uniform(600, 7200, stored_trips)
+    history = pd.DataFrame(
+        {
+            "trajectory_id": np.arange(stored_trips),
+            "vehicle_id": [f"H{index}" for index in range(stored_trips)],
+            "start_time": departure,
+            "end_time": departure + pd.to_timedelta(durations, unit="s"),
+            "duration": durations,
+            "start_lat": history_starts[:, 0],
+            "start_lng": history_starts[:, 1],
+            "end_lat": history_ends[:, 0],
+            "end_lng": history_ends[:, 1],
+            "num_points": 20,
+        }
+    )
+    queries = rng.integers(0, num_vehicles, num_reads)
+
+    def build():
+        system = MatrixTrackingSystem()
+        for vehicle, (start, end) in enumerate(zip(starts, ends)):
+            waypoints = [
+                tuple(start + (end - start) * t) for t in np.linspace(0, 1, 50)
+            ]
+            route = {
+                "waypoints": waypoints,
+                "distance": 70.0,
+                "duration": 3600,
+                "traffic_conditions": "normal",
+            }
+            system.register_route(f"V{vehicle}", *start, *end, departure, route)
+        system.trajectory_db.trajectories = history.copy()
+        return system
+
+    def ingest(system, vehicles):
+        for step in range(1, pings_per_vehicle + 1):
+            timestamp = departure + pd.Timedelta(seconds=10 * step)
+            for vehicle in vehicles:
+                lat, lng = starts[vehicle] + (ends[vehicle] - starts[vehicle]) * (
+                    step / (10 * pings_per_vehicle)
+                )
+                system.update_vehicle_position(f"V{vehicle}", lat, lng, timestamp)
+
+    def read(system, indexes):
+        for number, vehicle in enumerate(indexes):
+            kind = number % 4
+            if kind == 0:
+                system.get_vehicle_status(f"V{vehicle}")
+            elif kind == 1:
+                system.get_vehicle_status()
+            elif kind == 2:
+                system.trajectory_db.get_statistics()
+            else:
+                lat, lng = starts[vehicle]
+                system.trajectory_db.query_similar_trips(lat, lng, lat + 0.05, lng)
+
+    def store(system):
+        for index, points in enumerate(trips):
+            system.trajectory_db.store_trajectory(f"N{index}", points, trip_times)
+
+    total_ops = num_vehicles * pings_per_vehicle + num_reads + new_trips
+
+    system = build()
+    started = time.perf_counter()
+    ingest(system, range(num_vehicles))
+    read(system, queries)
+    store(system)
+    sequential = time.perf_counter() - started
+
+    system = build()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(ingest_threads + reader_threads) as executor:
+        futures = (
+            [
+                executor.submit(
+                    ingest, system, range(worker, num_vehicles, ingest_threads)
+                )
+                for worker in range(ingest_threads)
+            ]
+            + [
+                executor.submit(read, system, part)
+                for part in np.array_split(queries, reader_threads)
+            ]
+            + [executor.submit(store, system)]
+        )
+        for future in futures:
+            future.result()
+    concurrent = time.perf_counter() - started
+
+    consistent = (
+        all(
+            len(system.get_vehicle_status(f"V{vehicle}")["trajectory"])
+            == pings_per_vehicle + 1
+            for vehicle in range(num_vehicles)
+        )
+        and len(system.active_vehicles) == num_vehicles
+        and len(system.trajectory_db.trajectories) == stored_trips + new_trips
+    )
+    return {
+        "operations": total_ops,
+        "cpus": len(os.sched_getaffinity(0)),
+        "sequential_ops_per_second": total_ops / sequential,
+        "concurrent_ops_per_second": total_ops / concurrent,
+        "speedup": sequential / concurrent,
+        "consistent": consistent,
+    }
+
+
+if __name__ == "__main__":
+    result = stress_test()
+    print(
+        f"{result['operations']} operações em {result['cpus']} CPU(s): "
+        f"{result['sequential_ops_per_second']:,.0f} ops/s em uma thread, "
+        f"{result['concurrent_ops_per_second']:,.0f} ops/s concorrente "
+        f"({result['speedup']:.2f}x); estado consistente: {result['consistent']}"
+    )
+    if not result["consistent"]:
+        raise SystemExit("Estado inconsistente após a execução concorrente")
+    if result["cpus"] == 1:
+        print("Com uma única CPU as threads só se intercalam; o ganho exige mais CPUs.")
+    elif result["speedup"] <= 1:
+        raise SystemExit("O pool de threads não superou a execução em uma thread")
@@ -0,0 +1,213 @@
+from collections import defaultdict
+from src.lazy import lazy_import
+from src.features import geodesic
+
+np = lazy_import("numpy")
+pd = lazy_import("pandas")
+
+
+class GeofenceEngine:
+    KM_PER_DEGREE = 111.32
+
+    def __init__(self, cell_size=0.01, dwell_seconds=300, fast_distance=False):
+        # Zones are registered in every grid cell their bounding box touches,
+        # so a position is only tested against the zones of its own cell.
+        self.cell_size = cell_size
+        self.dwell_seconds = dwell_seconds
+        self.fast_distance = fast_distance
+        self.zones = []
+        self.zone_ids = {}
+        self.grid = defaultdict(list)
+        self.circles = {"lat": [], "lng": [], "radius": []}
+        self._circle_arrays = None
+        self.polygons = {}
+        self.vehicle_zones = {}
+
+    def add_circle(self, zone_id, lat, lng, radius_km, kind="site"):
+        lat_margin = radius_km / self.KM_PER_DEGREE
+        lng_margin = radius_km / (
+            self.KM_PER_DEGREE * max(np.cos(np.radians(lat)), 1e-6)
+        )
+        zone_index = self.register_zone(
+            zone_id,
+            kind,
+            "circle",
+            (lat - lat_margin, lng - lng_margin, lat + lat_margin, lng + lng_margin),
+        )
+        self.set_circle(lat, lng, radius_km)
+        return zone_index
+
+    def add_polygon(self, zone_id, points, kind="restricted"):
+        vertices = np.asarray(points, dtype=np.float64)
+        zone_index = self.register_zone(
+            zone_id,
+            kind,
+            "polygon",
+            (*vertices.min(axis=0), *vertices.max(axis=0)),
+        )
+        self.set_circle(np.nan, np.nan, np.nan)
+        self.polygons[zone_index] = vertices
+        return zone_index
+
+    def register_zone(self, zone_id, kind, shape, bbox):
+        zone_index = len(self.zones)
+        self.zones.append({"zone_id": zone_id, "kind": kind, "shape": shape})
+        self.zone_ids[zone_id] = zone_index
+
+        min_row, min_col = self.cell_of(bbox[0], bbox[1])
+        max_row, max_col = self.cell_of(bbox[2], bbox[3])
+        for row in range(int(min_row), int(max_row) + 1):
+            for col in range(int(min_col), int(max_col) + 1):
+                self.grid[(row, col)].append(zone_index)
+        return zone_index
+
+    def set_circle(self, lat, lng, radius_km):
+        self.circles["lat"].append(lat)
+        self.circles["lng"].append(lng)
+        self.circles["radius"].append(radius_km)
+        self._circle_arrays = None
+
+    def cell_of(self, lats, lngs):
+        rows = np.floor(np.asarray(lats) / self.cell_size).astype(np.int64)
+        cols = np.floor(np.asarray(lngs) / self.cell_size).astype(np.int64)
+        return rows, cols
+
+    def circle_arrays(self):
+        if self._circle_arrays is None:
+            self._circle_arrays = tuple(
+                np.asarray(self.circles[key], dtype=np.float64)
+                for key in ("lat", "lng", "radius")
+            )
+        return self._circle_arrays
+
+    def locate(self, lats, lngs):
+        # Returns (position index, zone index) pairs for every position that
+        # lies inside a zone.
+        lats = np.asarray(lats, dtype=np.float64)
+        lngs = np.asarray(lngs, dtype=np.float64)
+        point_indexes, zone_indexes = self.candidates(lats, lngs)
+        if len(point_indexes) == 0:
+            return point_indexes, zone_indexes
+
+        inside = np.zeros(len(point_indexes), dtype=bool)
+        circle_lat, circle_lng, circle_radius = self.circle_arrays()
+        is_circle = ~np.isnan(circle_radius[zone_indexes])
+        if is_circle.any():
+            points, zones = point_indexes[is_circle], zone_indexes[is_circle]
+            inside[is_circle] = (
+                geodesic.haversine(
+                    lats[points],
+                    lngs[points],
+                    circle_lat[zones],
+                    circle_lng[zones],
+                    fast=self.fast_distance,
+                )
+                <= circle_radius[zones]
+            )
+
+        polygon_positions = np.flatnonzero(~is_circle)
+        for zone_index in np.unique(zone_indexes[polygon_positions]):
+            selected = polygon_positions[zone_indexes[polygon_positions] == zone_index]
+            points = point_indexes[selected]
+            inside[selected] = self.contains(
+                self.polygons[zone_index], lats[points], lngs[points]
+            )
+
+        return point_indexes[inside], zone_indexes[inside]
+
+    def candidates(self, lats, lngs):
+        rows, cols = self.cell_of(lats, lngs)
+        cells, inverse = np.unique(
+            np.column_stack([rows, cols]), axis=0, return_inverse=True
+        )
+        inverse = inverse.ravel()
+        order = np.argsort(inverse, kind="stable")
+        bounds = np.searchsorted(inverse[order], np.arange(len(cells) + 1))
+
+        point_indexes, zone_indexes = [], []
+        for position, (row, col) in enumerate(cells.tolist()):
+            zones = self.grid.get((row, col))
+            if not zones:
+                continue
+            points = order[bounds[position] : bounds[position + 1]]
+            point_indexes.append(np.repeat(points, len(zones)))
+            zone_indexes.append(np.tile(zones, len(points)))
+
+        if not point_indexes:
+            empty = np.array([], dtype=np.int64)
+            return empty, empty
+        return np.concatenate(point_indexes), np.concatenate(zone_indexes)
+
+    def contains(self, vertices, lats, lngs):
+        # Even-odd ray casting, vectorized over positions and polygon edges.
+        lat_a, lng_a = vertices[:, 0], vertices[:, 1]
+        lat_b, lng_b = np.roll(lat_a, -1), np.roll(lng_a, -1)
+        lats, lngs = lats[:, None], lngs[:, None]
+
+        crosses = (lat_a > lats) != (lat_b > lats)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            intersection = lng_a + (lats - lat_a) * (lng_b - lng_a) / (lat_b - lat_a)
+        return ((crosses & (lngs < intersection)).sum(axis=1) % 2) == 1
+
+    def evaluate(self, vehicle_ids, lats, lngs, timestamps):
+        vehicle_ids = list(vehicle_ids)
+        timestamps = list(pd.to_datetime(list(timestamps)))
+        point_indexes, zone_indexes = self.locate(lats, lngs)
+
+        zones_by_point = defaultdict(set)
+        for point_index, zone_index in zip(
+            point_indexes.tolist(), zone_indexes.tolist()
+        ):
+            zones_by_point[point_index].add(zone_index)
+
+        events = []
+        for point_index, vehicle_id in enumerate(vehicle_ids):
+            events.extend(
+                self.transition(
+                    vehicle_id,
+                    zones_by_point.get(point_index, set()),
+                    timestamps[point_index],
+                )
+            )
+        return events
+
+    def transition(self, vehicle_id, current_zones, timestamp):
+        previous_zones = self.vehicle_zones.get(vehicle_id, {})
+        events = []
+
+        for zone_index in previous_zones.keys() - current_zones:
+            events.append(self.event(vehicle_id, zone_index, "exit", timestamp))
+
+        zones = {}
+        for zone_index in current_zones:
+            state = previous_zones.get(zone_index)
+            if state is None:
+                state = {"entered_at": timestamp, "dwell_reported": False}
+                events.append(self.event(vehicle_id, zone_index, "enter", timestamp))
+            elif (
+                not state["dwell_reported"]
+                and (timestamp - state["entered_at"]).total_seconds()
+                >= self.dwell_seconds
+            ):
+                state["dwell_reported"] = True
+                events.append(self.event(vehicle_id, zone_index, "dwell", timestamp))
+            zones[zone_index] = state
+
+        if zones:
+            self.vehicle_zones[vehicle_id] = zones
+        else:
+            self.vehicle_zones.pop(vehicle_id, None)
+        return events
+
+    def event(self, vehicle_id, zone_index, event_type, timestamp):
+        zone = self.zones[zone_index]
+        return {
+            "vehicle_id": vehicle_id,
+            "zone_id": zone["zone_id"],
+            "kind": zone["kind"],
+            "event": event_type,
+            "timestamp": timestamp,
+        }
+
+    def forget(self, vehicle_id):
+        self.vehicle_zones.pop(vehicle_id, None)
@@ -0,0 +1,170 @@
+import heapq
+from collections import OrderedDict
+from itertools import count
+from src.lazy import lazy_import
+
+pd = lazy_import("pandas")
+
+
+class VehicleLifecycleManager:
+    def __init__(
+        self,
+        stale_after_seconds=6 * 3600,
+        max_archived=10_000,
+        max_clock_skew_seconds=900,
+        clock_quorum=3,
+    ):
+        self.stale_after = pd.Timedelta(seconds=stale_after_seconds)
+        self.max_archived = max_archived
+        self.max_clock_skew = pd.Timedelta(seconds=max_clock_skew_seconds)
+        self.clock_quorum = clock_quorum
+        self.archive = OrderedDict()
+        self.last_seen = {}
+        # Fleet clock used for staleness. A ping more than max_clock_skew
+        # ahead of it only moves it once clock_quorum vehicles report such
+        # timestamps, so one device with a skewed clock cannot age the fleet.
+        self.clock = None
+        self.ahead = {}
+        # Min-heap of (last ping in ns, tie-breaker, vehicle_id); the counter
+        # keeps ids of different types from being compared. Entries
+        # superseded by a newer ping are skipped when popped and dropped on
+        # compaction.
+        self.heap = []
+        self.pushes = count()
+
+    def touch(self, vehicle_id, timestamp):
+        # A ping counts as seen at the fleet clock, whatever its own timestamp
+        # says, so a device lagging behind is not aged out while reporting.
+        self.observe(vehicle_id, pd.Timestamp(timestamp))
+        self.mark(vehicle_id, self.clock)
+
+    def register(self, vehicle_id, departure_time):
+        # Planned departures may lie in the future and do not move the clock.
+        departure_time = pd.Timestamp(departure_time)
+        if self.clock is not None and departure_time < self.clock:
+            departure_time = self.clock
+        self.mark(vehicle_id, departure_time)
+
+    def mark(self, vehicle_id, seen):
+        seen = pd.Timestamp(seen).value
+        self.last_seen[vehicle_id] = seen
+        heapq.heappush(self.heap, (seen, next(self.pushes), vehicle_id))
+        if len(self.heap) > 2 * len(self.last_seen) + 1024:
+            self.compact()
+
+    def observe(self, vehicle_id, timestamp):
+        if self.clock is None or timestamp <= self.clock + self.max_clock_skew:
+            if self.clock is None or timestamp > self.clock:
+                self.clock = timestamp
+            self.ahead.pop(vehicle_id, None)
+            return
+
+        self.ahead[vehicle_id] = timestamp
+        quorum = max(1, min(self.clock_quorum, len(self.last_seen)))
+        if len(self.ahead) >= quorum:
+            # The latest time that at least `quorum` vehicles have reached.
+            self.clock = sorted(self.ahead.values())[-quorum]
+            # The vehicles that were waiting for the quorum were marked at the
+            # old clock; they reported just now, so they must not be aged by
+            # the jump.
+            for ahead_id, seen in self.ahead.items():
+                if ahead_id in self.last_seen:
+                    self.mark(ahead_id, min(seen, self.clock))
+            self.ahead = {
+                vehicle_id: seen
+                for vehicle_id, seen in self.ahead.items()
+                if seen > self.clock + self.max_clock_skew
+            }
+
+    def compact(self):
+        self.heap = [
+            (seen, next(self.pushes), vehicle_id)
+            for vehicle_id, seen in self.last_seen.items()
+        ]
+        heapq.heapify(self.heap)
+
+    def stale_vehicles(self, now=None):
+        now = pd.Timestamp(now) if now is not None else self.clock
+        if now is None:
+            return []
+
+        cutoff = (now - self.stale_after).value
+        stale = []
+        while self.heap and self.heap[0][0] < cutoff:
+            seen, _, vehicle_id = heapq.heappop(self.heap)
+            if self.last_seen.get(vehicle_id) == seen:
+                del self.last_seen[vehicle_id]
+                self.ahead.pop(vehicle_id, None)
+                stale.append(vehicle_id)
+        return stale
+
+    def archive_vehicle(self, vehicle, reason, trajectory_id=None, time_result=None):
+        vehicle_id = vehicle["vehicle_id"]
+        self.last_seen.pop(vehicle_id, None)
+        self.ahead.pop(vehicle_id, None)
+        self.archive.pop(vehicle_id, None)
+        self.archive[vehicle_id] = self.summarize(
+            vehicle, reason, trajectory_id, time_result
+        )
+        if self.max_archived is not None and len(self.archive) > self.max_archived:
+            self.archive.popitem(last=False)
+        return self.archive[vehicle_id]
+
+    def summarize(self, vehicle, reason, trajectory_id, time_result):
+        summary = {
+            "vehicle_id": vehicle["vehicle_id"],
+            "status": vehicle["status"],
+            "archived_reason": reason,
+            "departure_time": pd.to_datetime(vehicle["departure_time"]),
+            "last_update": pd.to_datetime(vehicle["last_update"]),
+            "position": vehicle["current_position"],
+            "expected_duration": vehicle["expected_duration"],
+            "num_points": len(vehicle["trajectory"]),
+            "num_alerts": len(vehicle["alerts"]),
+            "trajectory_id": trajectory_id,
+        }
+        if time_result is not None:
+            summary["actual_duration"] = time_result["actual_duration"]
+            summary["deviation"] = time_result["deviation"]
+            summary["is_anomaly"] = time_result["is_anomaly"]
+        return summary
+
+    def lookup(self, vehicle_id):
+        return self.archive.get(vehicle_id)
+
+
+def check_clock_jump(clock_quorum=3):
+    # A morning shift, then a quiet gap longer than the TTL and a new shift
+    # whose first pings are far ahead of the fleet clock. None of the new
+    # vehicles may be aged out when the quorum moves the clock. Mixed id
+    # types with the same departure must also coexist in the heap.
+    lifecycle = VehicleLifecycleManager(clock_quorum=clock_quorum)
+    morning = pd.Timestamp("2024-01-01 08:00")
+    for index in range(6):
+        seen = morning + pd.Timedelta(minutes=4 * index)
+        lifecycle.register(f"m{index}", seen)
+        lifecycle.touch(f"m{index}", seen)
+
+    shift = pd.Timestamp("2024-01-01 15:00")
+    new_vehicles = ["x0", "x1", "x2", 3]
+    evicted = []
+    for offset in (0, 30):
+        for vehicle_id in new_vehicles:
+            if offset == 0:
+                lifecycle.register(vehicle_id, shift)
+            lifecycle.touch(vehicle_id, shift + pd.Timedelta(seconds=offset))
+            evicted += lifecycle.stale_vehicles()
+    return {
+        "clock": lifecycle.clock,
+        "evicted": evicted,
+        "new_vehicles_kept": not set(evicted) & set(new_vehicles),
+    }
+
+
+if __name__ == "__main__":
+    report = check_clock_jump()
+    print(
+        f"Relógio da frota em {report['clock']}; arquivados por inatividade: "
+        f"{report['evicted']}"
+    )
+    raise SystemExit(0 if report["new_vehicles_kept"] else 1)
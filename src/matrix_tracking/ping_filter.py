@@ -0,0 +1,74 @@
+import threading
+from src.features import geodesic
+
+
+class AdaptivePingFilter:
+    # Decides whether a ping needs the full evaluation (route deviation scan,
+    # progress/ETA and delay alert). Every ping moves a vehicle by at most
+    # `moved` km from the last evaluated position, so by the triangle
+    # inequality its distance to the route is at most the last one + moved
+    # and its distance to the destination at least the last one - moved.
+    # A ping is only skipped when those bounds prove that neither a route
+    # anomaly nor an arrival can have happened.
+    def __init__(self, min_movement_km=0.05, max_skip_seconds=60):
+        self.min_movement_km = min_movement_km
+        self.max_skip_seconds = max_skip_seconds
+        # Set by bind() from the system that uses the filter.
+        self.max_route_distance_km = None
+        self.arrival_radius_km = None
+        # Pings of different shards are filtered in parallel.
+        self.counter_lock = threading.Lock()
+        self.evaluated = 0
+        self.skipped = 0
+
+    def bind(self, max_route_distance_km, arrival_radius_km):
+        # The bounds are only sound with the thresholds of the full evaluation.
+        self.max_route_distance_km = max_route_distance_km
+        self.arrival_radius_km = arrival_radius_km
+
+    def should_evaluate(self, vehicle, lat, lng, timestamp):
+        last = vehicle.get("last_evaluation")
+        evaluate = last is None or self.must_evaluate(last, lat, lng, timestamp)
+        with self.counter_lock:
+            if evaluate:
+                self.evaluated += 1
+            else:
+                self.skipped += 1
+        return evaluate
+
+    def must_evaluate(self, last, lat, lng, timestamp):
+        if (timestamp - last["timestamp"]).total_seconds() >= self.max_skip_seconds:
+            return True
+
+        # Exact haversine so the triangle inequality holds even when the
+        # system uses the fast distance approximation.
+        moved = geodesic.point_distance(last["position"], (lat, lng))
+        return (
+            moved >= self.min_movement_km
+            or last["distance_from_route"] + moved > self.max_route_distance_km
+            or last["distance_to_end"] - moved < self.arrival_radius_km
+        )
+
+    def record(
+        self, vehicle, lat, lng, timestamp, distance_from_route, distance_to_end, result
+    ):
+        vehicle["last_evaluation"] = {
+            "position": (lat, lng),
+            "timestamp": timestamp,
+            "distance_from_route": distance_from_route,
+            "distance_to_end": distance_to_end,
+            "result": result,
+        }
+
+    def skip_ratio(self):
+        return self.stats()["skip_ratio"]
+
+    def stats(self):
+        with self.counter_lock:
+            evaluated, skipped = self.evaluated, self.skipped
+        total = evaluated + skipped
+        return {
+            "evaluated": evaluated,
+            "skipped": skipped,
+            "skip_ratio": skipped / total if total else 0.0,
+        }
@@ -0,0 +1,230 @@
+import gc
+import multiprocessing
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from src.lazy import lazy_import
+from src.predict.duration_preditcor import DurationPredictor
+from src.predict.model_store import load_duration_model, load_kmeans_models
+from .anomaly_detector import AnomalyDetector
+
+np = lazy_import("numpy")
+pd = lazy_import("pandas")
+
+
+def trip_inputs(trajectories):
+    # Stored trips keep the departure as start_time; the predictor expects the
+    # same five columns used by detect_time_anomalies.
+    inputs = trajectories[["start_lng", "start_lat", "end_lng", "end_lat"]].copy()
+    inputs["datetime"] = trajectories["start_time"]
+    return inputs
+
+
+def actual_durations(trajectories):
+    if "actual_duration" in trajectories:
+        return trajectories["actual_duration"].fillna(trajectories["duration"])
+    return trajectories["duration"]
+
+
+def completed_trips(trajectories):
+    # Stale partial trips (and vehicles archived before their first ping) have
+    # no full duration to compare with the model; they are not re-scored.
+    if "status" not in trajectories and "actual_duration" not in trajectories:
+        return np.ones(len(trajectories), dtype=bool)
+    completed = np.zeros(len(trajectories), dtype=bool)
+    if "status" in trajectories:
+        completed |= (trajectories["status"] == "completed").to_numpy()
+    if "actual_duration" in trajectories:
+        completed |= trajectories["actual_duration"].notna().to_numpy()
+    return completed
+
+
+def merge_column(trajectories, name, values, rows, default):
+    # Only the re-scored rows change; the others keep their value, or the
+    # default when the column is new.
+    if name in trajectories:
+        column = trajectories[name].copy()
+    else:
+        column = pd.Series([default] * len(trajectories), index=trajectories.index)
+    column[rows] = values
+    return column
+
+
+def iter_chunks(trajectories, chunk_size):
+    for offset in range(0, len(trajectories), chunk_size):
+        yield offset, trip_inputs(trajectories.iloc[offset : offset + chunk_size])
+
+
+def predict_chunk(offset, chunk, model_path=None):
+    # Rows dropped by the feature pipeline come back as NaN predictions.
+    predictions = DurationPredictor(model_path=model_path).predict_many(chunk)
+    predictions = predictions.reindex(chunk.index).to_numpy(dtype=np.float64)
+    return offset, predictions
+
+
+def rescore_trajectories(
+    trajectory_db,
+    model_path=None,
+    chunk_size=10_000,
+    num_workers=None,
+    threshold=0.8,
+    progress=None,
+):
+    stored, _ = trajectory_db.frames()
+    rows = completed_trips(stored)
+    trajectories = stored[rows]
+    total = len(trajectories)
+    predictions = np.full(total, np.nan)
+    started = time.perf_counter()
+
+    # Models are loaded once in the parent and inherited by the forked
+    # workers, so no chunk pays for an unpickle.
+    load_duration_model(model_path)
+    load_kmeans_models()
+
+    def report(done):
+        elapsed = time.perf_counter() - started
+        if progress is not None:
+            progress(done, total, done / elapsed if elapsed > 0 else 0.0)
+
+    done = 0
+    chunks = iter_chunks(trajectories, chunk_size)
+    if num_workers == 1 or total <= chunk_size:
+        for offset, chunk in chunks:
+            _, values = predict_chunk(offset, chunk, model_path)
+            predictions[offset : offset + len(values)] = values
+            done += len(values)
+            report(done)
+    else:
+        gc.freeze()
+        try:
+            context = multiprocessing.get_context("fork")
+            num_workers = num_workers or os.cpu_count()
+            with ProcessPoolExecutor(num_workers, mp_context=context) as executor:
+                # Keep at most two chunks per worker in flight so the chunk
+                # copies sent to the pool stay bounded.
+                max_pending = 2 * num_workers
+                pending = set()
+                for offset, chunk in chunks:
+                    pending.add(
+                        executor.submit(predict_chunk, offset, chunk, model_path)
+                    )
+                    if len(pending) < max_pending:
+                        continue
+                    finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        offset, values = future.result()
+                        predictions[offset : offset + len(values)] = values
+                        done += len(values)
+                        report(done)
+                for future in pending:
+                    offset, values = future.result()
+                    predictions[offset : offset + len(values)] = values
+                    done += len(values)
+                    report(done)
+        finally:
+            gc.unfreeze()
+
+    scores = AnomalyDetector(threshold).classify_deviations(
+        actual_durations(trajectories), predictions
+    )
+    # Rows the feature pipeline dropped have no prediction; they are reported
+    # apart and left out of the anomaly rate.
+    scored = ~np.isnan(scores["deviation"])
+
+    previous_rate = None
+    if "deviation" in trajectories:
+        previous = trajectories["deviation"].to_numpy(dtype=np.float64)
+        previous = previous[~np.isnan(previous)]
+        if len(previous):
+            previous_rate = float(np.mean(np.abs(previous) > threshold))
+
+    updates = {"predicted_duration": predictions, **scores}
+    if "deviation" in trajectories:
+        updates["previous_deviation"] = trajectories["deviation"].to_numpy()
+    defaults = {
+        "predicted_duration": np.nan,
+        "deviation": np.nan,
+        "is_anomaly": False,
+        "anomaly_type": None,
+        "previous_deviation": np.nan,
+    }
+    rescored = stored.assign(
+        **{
+            name: merge_column(stored, name, values, rows, defaults[name])
+            for name, values in updates.items()
+        }
+    )
+    with trajectory_db.lock:
+        # Trips stored while the job ran are appended after the scored rows
+        # and keep their original columns.
+        current = trajectory_db.trajectories
+        if len(current) > len(stored):
+            rescored = pd.concat(
+                [rescored, current.iloc[len(stored) :]], ignore_index=True
+            )
+        trajectory_db.trajectories = rescored
+
+    elapsed = time.perf_counter() - started
+    return {
+        "rows": total,
+        "seconds": elapsed,
+        "rows_per_second": total / elapsed if elapsed > 0 else 0.0,
+        "not_completed": int(len(stored) - total),
+        "unscored": int(total - scored.sum()),
+        "anomaly_rate": (
+            float(np.mean(scores["is_anomaly"][scored])) if scored.any() else None
+        ),
+        "previous_anomaly_rate": previous_rate,
+    }
+
+
+def print_progress(done, total, rows_per_second):
+    print(f"Reavaliadas {done}/{total} viagens ({rows_per_second:,.0f} linhas/s)")
+
+
+if __name__ == "__main__":
+    import argparse
+    from .trajectory_database import TrajectoryDatabase
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--trips", type=int, default=100_000)
+    parser.add_argument("--chunk-size", type=int, default=10_000)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--model-path", default=None)
+    args = parser.parse_args()
+
+    # Synthetic trips around São Paulo, stored directly as trajectory rows.
+    rng = np.random.default_rng(0)
+    start_times = pd.Timestamp("2024-01-01") + pd.to_timedelta(
+        rng.integers(0, 30 * 24 * 3600, args.trips), unit="s"
+    )
+    durations = rng.uniform(300, 7200, args.trips)
+    database = TrajectoryDatabase()
+    database.trajectories = pd.DataFrame(
+        {
+            "vehicle_id": [f"V{index}" for index in range(args.trips)],
+            "start_time": start_times,
+            "end_time": start_times + pd.to_timedelta(durations, unit="s"),
+            "duration": durations,
+            "start_lat": rng.uniform(-23.7, -23.4, args.trips),
+            "start_lng": rng.uniform(-46.8, -46.4, args.trips),
+            "end_lat": rng.uniform(-23.7, -23.4, args.trips),
+            "end_lng": rng.uniform(-46.8, -46.4, args.trips),
+            "deviation": rng.normal(0, 0.5, args.trips),
+        }
+    )
+
+    result = rescore_trajectories(
+        database,
+        model_path=args.model_path,
+        chunk_size=args.chunk_size,
+        num_workers=args.workers,
+        progress=print_progress,
+    )
+    print(
+        f"{result['rows']} viagens em {result['seconds']:.1f} s "
+        f"({result['rows_per_second']:,.0f} linhas/s), {result['unscored']} sem "
+        f"previsão, {result['not_completed']} não concluídas; taxa de anomalias "
+        f"{result['previous_anomaly_rate']:.1%} -> {result['anomaly_rate']:.1%}"
+    )
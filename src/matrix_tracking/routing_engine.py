@@ -1,21 +1,28 @@
 import warnings
-import numpy as np
-import pandas as pd
-import haversine as hs
 from datetime import datetime
+from src.lazy import lazy_import
+from src.features import geodesic
 from src.predict.duration_preditcor import DurationPredictor
 
+np = lazy_import("numpy")
+pd = lazy_import("pandas")
+
 warnings.filterwarnings("ignore")
 
 
 def routing_engine_calculate_route(
-    start_lat, start_lng, end_lat, end_lng, departure_time=None
+    start_lat,
+    start_lng,
+    end_lat,
+    end_lng,
+    departure_time=None,
+    travel_time_matrix=None,
 ):
 
-    distance_km = hs.haversine((start_lat, start_lng), (end_lat, end_lng))
+    distance_km = geodesic.point_distance((start_lat, start_lng), (end_lat, end_lng))
 
-    duration_predictor = DurationPredictor()
-    estimated_time = duration_predictor.predict(
+    duration_predictor = DurationPredictor(travel_time_matrix)
+    estimated_time = duration_predictor.predict_approximate(
         start_lng,
         start_lat,
         end_lng,
@@ -25,7 +32,7 @@ def routing_engine_calculate_route(
             if departure_time
             else datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         ),
-    )[0]
+    )
 
     waypoints = simulate_route(distance_km, start_lat, start_lng, end_lat, end_lng)
     traffic_conditions = simulate_traffic_conditions(departure_time)
@@ -0,0 +1,180 @@
+from __future__ import annotations
+from collections import defaultdict
+from src.lazy import lazy_import
+
+np = lazy_import("numpy")
+pd = lazy_import("pandas")
+
+NS_PER_HOUR = 3600 * 10**9
+
+
+def time_range_ns(start, end):
+    start = np.iinfo(np.int64).min if start is None else pd.Timestamp(start).value
+    end = np.iinfo(np.int64).max if end is None else pd.Timestamp(end).value
+    return start, end
+
+
+def hour_of_day(start_time_ns):
+    return (start_time_ns // NS_PER_HOUR) % 24
+
+
+class SegmentIndex:
+    # Segments are bucketed by the grid cell of their start point and kept
+    # sorted by start time inside each bucket, so a query only touches the
+    # buckets overlapping its bounding box and binary-searches the time range.
+    COLUMNS = ["start_lat", "start_lng", "end_lat", "end_lng", "distance", "speed"]
+
+    def __init__(self, cell_size=0.05):
+        self.cell_size = cell_size
+        self.partitions = {}
+        self.pending = defaultdict(list)
+
+    def cell_of(self, lats, lngs):
+        rows = np.floor(np.asarray(lats, dtype=np.float64) / self.cell_size)
+        cols = np.floor(np.asarray(lngs, dtype=np.float64) / self.cell_size)
+        return rows.astype(np.int64), cols.astype(np.int64)
+
+    def add(self, segments: pd.DataFrame):
+        if len(segments) == 0:
+            return
+
+        columns = {
+            column: segments[column].to_numpy(dtype=np.float64)
+            for column in self.COLUMNS
+        }
+        columns["start_time"] = (
+            pd.DatetimeIndex(segments["start_time"]).as_unit("ns").asi8
+        )
+        rows, cols = self.cell_of(columns["start_lat"], columns["start_lng"])
+        cells, inverse = np.unique(
+            np.column_stack([rows, cols]), axis=0, return_inverse=True
+        )
+        inverse = inverse.ravel()
+        for position, cell in enumerate(map(tuple, cells.tolist())):
+            selected = inverse == position
+            self.pending[cell].append(
+                {name: values[selected] for name, values in columns.items()}
+            )
+
+    def partition(self, cell):
+        # New segments are merged into the sorted arrays lazily, on the first
+        # query that touches the bucket.
+        chunks = self.pending.pop(cell, [])
+        if cell in self.partitions:
+            chunks.insert(0, self.partitions[cell])
+        if not chunks:
+            return None
+
+        merged = {
+            name: np.concatenate([chunk[name] for chunk in chunks])
+            for name in chunks[0]
+        }
+        order = np.argsort(merged["start_time"], kind="stable")
+        self.partitions[cell] = {name: values[order] for name, values in merged.items()}
+        return self.partitions[cell]
+
+    def cells_in_bbox(self, bbox):
+        known = self.partitions.keys() | self.pending.keys()
+        if bbox is None:
+            return list(known)
+
+        rows, cols = self.cell_of([bbox[0], bbox[2]], [bbox[1], bbox[3]])
+        (min_row, max_row), (min_col, max_col) = rows.tolist(), cols.tolist()
+        if (max_row - min_row + 1) * (max_col - min_col + 1) > len(known):
+            return [
+                (row, col)
+                for row, col in known
+                if min_row <= row <= max_row and min_col <= col <= max_col
+            ]
+        return [
+            (row, col)
+            for row in range(min_row, max_row + 1)
+            for col in range(min_col, max_col + 1)
+            if (row, col) in known
+        ]
+
+    def query(self, bbox=None, start=None, end=None, hours=None) -> pd.DataFrame:
+        # bbox is (min_lat, min_lng, max_lat, max_lng) on the segment start
+        # point, [start, end) bounds the segment start time and hours=(7, 9)
+        # keeps segments starting from 07:00 up to, not including, 09:00.
+        start_ns, end_ns = time_range_ns(start, end)
+        matches = []
+        for cell in self.cells_in_bbox(bbox):
+            partition = self.partition(cell)
+            low, high = np.searchsorted(partition["start_time"], [start_ns, end_ns])
+            if low == high:
+                continue
+
+            selected = {name: values[low:high] for name, values in partition.items()}
+            mask = np.ones(high - low, dtype=bool)
+            if bbox is not None:
+                mask &= (
+                    (selected["start_lat"] >= bbox[0])
+                    & (selected["start_lat"] <= bbox[2])
+                    & (selected["start_lng"] >= bbox[1])
+                    & (selected["start_lng"] <= bbox[3])
+                )
+            if hours is not None:
+                hour = hour_of_day(selected["start_time"])
+                mask &= (hour >= hours[0]) & (hour < hours[1])
+            matches.append({name: values[mask] for name, values in selected.items()})
+
+        if not matches:
+            return pd.DataFrame(columns=["start_time"] + self.COLUMNS)
+
+        result = pd.DataFrame(
+            {
+                name: np.concatenate([match[name] for match in matches])
+                for name in ["start_time"] + self.COLUMNS
+            }
+        )
+        result["start_time"] = pd.to_datetime(result["start_time"])
+        return result
+
+    def average_speed(self, bbox=None, start=None, end=None, hours=None):
+        segments = self.query(bbox, start, end, hours)
+        return float(segments["speed"].mean()) if len(segments) > 0 else None
+
+
+class SpeedHeatmap:
+    # Running speed sums and counts per (grid row, grid column, hour of day);
+    # update() folds in new segments without revisiting old ones.
+    def __init__(self, bbox, cell_size=0.01):
+        self.bbox = bbox
+        self.cell_size = cell_size
+        self.shape = (
+            int(np.ceil((bbox[2] - bbox[0]) / cell_size)),
+            int(np.ceil((bbox[3] - bbox[1]) / cell_size)),
+            24,
+        )
+        self.speed_sum = np.zeros(self.shape, dtype=np.float64)
+        self.counts = np.zeros(self.shape, dtype=np.int64)
+
+    def update(self, segments: pd.DataFrame):
+        if len(segments) == 0:
+            return self
+
+        lats = segments["start_lat"].to_numpy(dtype=np.float64)
+        lngs = segments["start_lng"].to_numpy(dtype=np.float64)
+        rows = np.floor((lats - self.bbox[0]) / self.cell_size).astype(np.int64)
+        cols = np.floor((lngs - self.bbox[1]) / self.cell_size).astype(np.int64)
+        hours = hour_of_day(pd.DatetimeIndex(segments["start_time"]).as_unit("ns").asi8)
+        inside = (
+            (rows >= 0) & (rows < self.shape[0]) & (cols >= 0) & (cols < self.shape[1])
+        )
+
+        flat_index = np.ravel_multi_index(
+            (rows[inside], cols[inside], hours[inside]), self.shape
+        )
+        size = self.counts.size
+        self.speed_sum += np.bincount(
+            flat_index,
+            weights=segments["speed"].to_numpy(dtype=np.float64)[inside],
+            minlength=size,
+        ).reshape(self.shape)
+        self.counts += np.bincount(flat_index, minlength=size).reshape(self.shape)
+        return self
+
+    def mean(self):
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(self.counts > 0, self.speed_sum / self.counts, np.nan)
@@ -0,0 +1,560 @@
+import json
+import os
+import struct
+import threading
+import time
+from collections import defaultdict
+from pathlib import Path
+from src.lazy import lazy_import
+
+np = lazy_import("numpy")
+pd = lazy_import("pandas")
+
+SNAPSHOT_MAGIC = b"MCSNAP02"
+HEADER_LENGTH = struct.Struct("<Q")
+# Every journal record carries a sequence number after its kind byte.
+PING_RECORD = struct.Struct("<BQddqH")
+PLAN_RECORD = struct.Struct("<BQI")
+PING = 1
+PLAN = 2
+STATUSES = ["planned", "active", "completed", "stale"]
+
+# Snapshot layout: magic, header length, JSON header (ids, strings, alerts,
+# array descriptors), then every array as a raw 8-byte aligned block.
+VEHICLE_FLOATS = [
+    "start_lat",
+    "start_lng",
+    "end_lat",
+    "end_lng",
+    "current_lat",
+    "current_lng",
+    "expected_duration",
+    "route_distance",
+    "route_duration",
+]
+VEHICLE_TIMES = ["departure_time", "expected_arrival", "last_update"]
+
+
+def capture_state(vehicles, archive) -> tuple:
+    # Works on the copies returned by MatrixTrackingSystem.vehicle_copies().
+    count = len(vehicles)
+
+    floats = np.array(
+        [
+            (
+                vehicle["start_lat"],
+                vehicle["start_lng"],
+                vehicle["end_lat"],
+                vehicle["end_lng"],
+                vehicle["current_position"][0],
+                vehicle["current_position"][1],
+                vehicle["expected_duration"],
+                vehicle["planned_route"]["distance"],
+                vehicle["planned_route"]["duration"],
+            )
+            for vehicle in vehicles
+        ],
+        dtype=np.float64,
+    ).reshape(count, len(VEHICLE_FLOATS))
+    times = np.column_stack(
+        [
+            datetimes_to_ns([vehicle[name] for vehicle in vehicles])
+            for name in VEHICLE_TIMES
+        ]
+    ).reshape(count, len(VEHICLE_TIMES))
+    status_codes = {status: code for code, status in enumerate(STATUSES)}
+
+    arrays = {
+        "vehicle_floats": floats,
+        "vehicle_times": times,
+        "status": np.array(
+            [status_codes[vehicle["status"]] for vehicle in vehicles], dtype=np.uint8
+        ),
+        "journal_sequence": np.array(
+            [vehicle.get("journal_sequence", 0) for vehicle in vehicles],
+            dtype=np.uint64,
+        ),
+        "trajectory_offsets": offsets(vehicle["trajectory"] for vehicle in vehicles),
+        "trajectory": points(
+            point for vehicle in vehicles for point in vehicle["trajectory"]
+        ),
+        "timestamps": datetimes_to_ns(
+            [timestamp for vehicle in vehicles for timestamp in vehicle["timestamps"]]
+        ),
+        "waypoint_offsets": offsets(
+            vehicle["planned_route"]["waypoints"] for vehicle in vehicles
+        ),
+        "waypoints": points(
+            point
+            for vehicle in vehicles
+            for point in vehicle["planned_route"]["waypoints"]
+        ),
+    }
+    header = {
+        "created_at": time.time(),
+        "vehicle_ids": [vehicle["vehicle_id"] for vehicle in vehicles],
+        "traffic_conditions": [
+            vehicle["planned_route"]["traffic_conditions"] for vehicle in vehicles
+        ],
+        # Only the alerts of tracked vehicles; the global feed is capped.
+        "alerts": [
+            encode_alert(alert)
+            for alert in sorted(
+                (alert for vehicle in vehicles for alert in vehicle["alerts"]),
+                key=lambda alert: alert["timestamp"],
+            )
+        ],
+        "archive": archive,
+    }
+    return header, arrays
+
+
+def offsets(sequences):
+    lengths = np.fromiter((len(sequence) for sequence in sequences), dtype=np.int64)
+    return np.concatenate([[0], np.cumsum(lengths)])
+
+
+def datetimes_to_ns(values):
+    return pd.DatetimeIndex(values).as_unit("ns").asi8.astype(np.int64)
+
+
+def ns_to_datetimes(values):
+    # Plain datetime objects are far cheaper to create than pd.Timestamp and
+    # interoperate with it; pings carry no sub-microsecond information.
+    return values.view("datetime64[ns]").astype("datetime64[us]").tolist()
+
+
+def points(values):
+    return np.array(list(values), dtype=np.float64).reshape(-1, 2)
+
+
+def encode_alert(alert):
+    return {**alert, "timestamp": pd.Timestamp(alert["timestamp"]).value}
+
+
+def decode_alert(alert):
+    return {**alert, "timestamp": pd.Timestamp(alert["timestamp"])}
+
+
+def json_default(value):
+    if isinstance(value, pd.Timestamp):
+        return {"__timestamp__": value.value}
+    if isinstance(value, np.generic):
+        return value.item()
+    return str(value)
+
+
+def json_object_hook(value):
+    if "__timestamp__" in value:
+        return pd.Timestamp(value["__timestamp__"])
+    return value
+
+
+def write_snapshot(path, header, arrays):
+    descriptors = {}
+    offset = 0
+    for name, array in arrays.items():
+        descriptors[name] = {
+            "dtype": array.dtype.str,
+            "shape": list(array.shape),
+            "offset": offset,
+        }
+        offset += aligned(array.nbytes)
+
+    header_bytes = json.dumps(
+        {**header, "arrays": descriptors}, default=json_default
+    ).encode()
+    prefix = SNAPSHOT_MAGIC + HEADER_LENGTH.pack(len(header_bytes)) + header_bytes
+
+    path = Path(path)
+    temporary_path = path.with_suffix(".tmp")
+    with open(temporary_path, "wb") as f:
+        f.write(prefix + padding(len(prefix)))
+        for array in arrays.values():
+            f.write(np.ascontiguousarray(array).reshape(-1).view(np.uint8).data)
+            f.write(padding(array.nbytes))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary_path, path)
+
+
+def read_snapshot(path) -> tuple:
+    data = Path(path).read_bytes()
+    if data[: len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+        raise ValueError(f"Snapshot inválido: {path}")
+
+    (header_length,) = HEADER_LENGTH.unpack_from(data, len(SNAPSHOT_MAGIC))
+    header_start = len(SNAPSHOT_MAGIC) + HEADER_LENGTH.size
+    header = json.loads(
+        data[header_start : header_start + header_length],
+        object_hook=json_object_hook,
+    )
+    data_start = aligned(header_start + header_length)
+
+    arrays = {}
+    for name, descriptor in header.pop("arrays").items():
+        dtype = np.dtype(descriptor["dtype"])
+        shape = tuple(descriptor["shape"])
+        arrays[name] = np.frombuffer(
+            data,
+            dtype=dtype,
+            count=int(np.prod(shape)),
+            offset=data_start + descriptor["offset"],
+        ).reshape(shape)
+    return header, arrays
+
+
+def aligned(size):
+    return (size + 7) // 8 * 8
+
+
+def padding(size):
+    return b"\0" * (aligned(size) - size)
+
+
+def restore_state(system, header, arrays):
+    vehicle_ids = header["vehicle_ids"]
+    floats = dict(zip(VEHICLE_FLOATS, arrays["vehicle_floats"].T.tolist()))
+    times = {
+        name: pd.to_datetime(column).to_list()
+        for name, column in zip(VEHICLE_TIMES, arrays["vehicle_times"].T)
+    }
+    status = arrays["status"].tolist()
+    journal_sequences = arrays["journal_sequence"].tolist()
+
+    trajectory_offsets = arrays["trajectory_offsets"].tolist()
+    trajectory_lats = arrays["trajectory"][:, 0].tolist()
+    trajectory_lngs = arrays["trajectory"][:, 1].tolist()
+    timestamps = ns_to_datetimes(arrays["timestamps"])
+    waypoint_offsets = arrays["waypoint_offsets"].tolist()
+    waypoint_lats = arrays["waypoints"][:, 0].tolist()
+    waypoint_lngs = arrays["waypoints"][:, 1].tolist()
+
+    alerts = [decode_alert(alert) for alert in header["alerts"]]
+    system.alerts.clear()
+    system.alerts.extend(alerts)
+    alerts_by_vehicle = defaultdict(list)
+    for alert in alerts:
+        alerts_by_vehicle[alert["vehicle_id"]].append(alert)
+
+    system.active_vehicles = {}
+    system.vehicle_views = {}
+    for index, vehicle_id in enumerate(vehicle_ids):
+        start, end = trajectory_offsets[index], trajectory_offsets[index + 1]
+        first, last = waypoint_offsets[index], waypoint_offsets[index + 1]
+        route = {
+            "distance": floats["route_distance"][index],
+            "duration": floats["route_duration"][index],
+            "waypoints": list(
+                zip(waypoint_lats[first:last], waypoint_lngs[first:last])
+            ),
+            "traffic_conditions": header["traffic_conditions"][index],
+        }
+        system.active_vehicles[vehicle_id] = {
+            "vehicle_id": vehicle_id,
+            "start_lat": floats["start_lat"][index],
+            "start_lng": floats["start_lng"][index],
+            "end_lat": floats["end_lat"][index],
+            "end_lng": floats["end_lng"][index],
+            "departure_time": times["departure_time"][index],
+            "planned_route": route,
+            "expected_duration": floats["expected_duration"][index],
+            "expected_arrival": times["expected_arrival"][index],
+            "current_position": (
+                floats["current_lat"][index],
+                floats["current_lng"][index],
+            ),
+            "last_update": times["last_update"][index],
+            "trajectory": list(
+                zip(trajectory_lats[start:end], trajectory_lngs[start:end])
+            ),
+            "timestamps": timestamps[start:end],
+            "status": STATUSES[status[index]],
+            "alerts": alerts_by_vehicle.get(vehicle_id, []),
+            "journal_sequence": journal_sequences[index],
+        }
+        system.publish(vehicle_id)
+        system.lifecycle.mark(vehicle_id, times["last_update"][index])
+        system.lifecycle.observe(vehicle_id, times["last_update"][index])
+
+    for summary in header["archive"]:
+        summary["position"] = tuple(summary["position"])
+        system.lifecycle.archive[summary["vehicle_id"]] = summary
+
+
+class PingJournal:
+    def __init__(self, path, fsync=False):
+        self.path = Path(path)
+        self.fsync = fsync
+        self.file = open(self.path, "ab")
+
+    def append(self, record: bytes):
+        self.file.write(record)
+        self.file.flush()
+        if self.fsync:
+            os.fsync(self.file.fileno())
+
+    def record_ping(self, sequence, vehicle_id, lat, lng, timestamp):
+        # JSON keeps the id's type (e.g. int ids), as in plan records and the
+        # snapshot header.
+        vehicle_id = json.dumps(vehicle_id, default=json_default).encode()
+        self.append(
+            PING_RECORD.pack(
+                PING,
+                sequence,
+                lat,
+                lng,
+                pd.Timestamp(timestamp).value,
+                len(vehicle_id),
+            )
+            + vehicle_id
+        )
+
+    def record_plan(
+        self,
+        sequence,
+        vehicle_id,
+        start_lat,
+        start_lng,
+        end_lat,
+        end_lng,
+        departure_time,
+        route,
+    ):
+        payload = json.dumps(
+            {
+                "vehicle_id": vehicle_id,
+                "start_lat": start_lat,
+                "start_lng": start_lng,
+                "end_lat": end_lat,
+                "end_lng": end_lng,
+                "departure_time": pd.Timestamp(departure_time).value,
+                "route": route,
+            },
+            default=json_default,
+        ).encode()
+        self.append(PLAN_RECORD.pack(PLAN, sequence, len(payload)) + payload)
+
+    def close(self):
+        self.file.close()
+
+    @staticmethod
+    def read(path) -> tuple:
+        # Returns the decoded records and the length of the valid prefix; a
+        # record cut short by a crash ends the journal.
+        data = Path(path).read_bytes()
+        records = []
+        position = 0
+        while position < len(data):
+            kind = data[position]
+            if kind == PING and position + PING_RECORD.size <= len(data):
+                _, sequence, lat, lng, timestamp, size = PING_RECORD.unpack_from(
+                    data, position
+                )
+                end = position + PING_RECORD.size + size
+                if end > len(data):
+                    break
+                vehicle_id = json.loads(data[position + PING_RECORD.size : end])
+                records.append(
+                    (PING, sequence, (vehicle_id, lat, lng, pd.Timestamp(timestamp)))
+                )
+            elif kind == PLAN and position + PLAN_RECORD.size <= len(data):
+                _, sequence, size = PLAN_RECORD.unpack_from(data, position)
+                end = position + PLAN_RECORD.size + size
+                if end > len(data):
+                    break
+                records.append(
+                    (
+                        PLAN,
+                        sequence,
+                        json.loads(data[position + PLAN_RECORD.size : end]),
+                    )
+                )
+            else:
+                break
+            position = end
+        return records, position
+
+
+class SnapshotManager:
+    def __init__(self, directory, interval_seconds=None, fsync=False):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.interval_seconds = interval_seconds
+        self.fsync = fsync
+        self.system = None
+        self.journal = None
+        self.sequence = 0
+        # Numbers every journal record; guarded by the system's state_lock.
+        self.record_sequence = 0
+        self.writer = None
+        self.last_snapshot = time.monotonic()
+        self.snapshot_lock = threading.Lock()
+
+    def snapshot_path(self, sequence):
+        return self.directory / f"snapshot-{sequence:08d}.bin"
+
+    def journal_path(self, sequence):
+        return self.directory / f"journal-{sequence:08d}.log"
+
+    def sequences(self, prefix):
+        # Only files named like snapshot_path()/journal_path(); anything else
+        # in the directory is left alone.
+        suffix = ".bin" if prefix == "snapshot" else ".log"
+        numbers = (
+            path.stem[len(prefix) + 1 :]
+            for path in self.directory.glob(f"{prefix}-*{suffix}")
+        )
+        return sorted(int(number) for number in numbers if number.isdigit())
+
+    def attach(self, system, sequence=None):
+        self.system = system
+        if sequence is None:
+            sequence = max(self.sequences("journal") + self.sequences("snapshot") + [0])
+        self.sequence = sequence
+        self.journal = PingJournal(self.journal_path(sequence), self.fsync)
+        system.journal = self
+        return self
+
+    def record_plan(self, *args):
+        self.record_sequence += 1
+        self.journal.record_plan(self.record_sequence, *args)
+        return self.record_sequence
+
+    def record_ping(self, *args):
+        self.record_sequence += 1
+        self.journal.record_ping(self.record_sequence, *args)
+        return self.record_sequence
+
+    def maybe_snapshot(self):
+        # Called by the system before an update takes its locks, so a capture
+        # never waits on the caller's own shard. Only one thread captures; the
+        # others carry on.
+        if (
+            self.interval_seconds is None
+            or time.monotonic() - self.last_snapshot < self.interval_seconds
+            or self.writing()
+            or not self.snapshot_lock.acquire(blocking=False)
+        ):
+            return
+        try:
+            if time.monotonic() - self.last_snapshot >= self.interval_seconds:
+                self.snapshot()
+        finally:
+            self.snapshot_lock.release()
+
+    def writing(self):
+        return self.writer is not None and self.writer.is_alive()
+
+    def snapshot(self, wait=False):
+        # Only capturing the state happens on the caller's thread; the file is
+        # written in the background while ingestion continues.
+        if self.writing():
+            self.writer.join()
+
+        # The journal switches to the new segment first, then the vehicles are
+        # copied from their published views while ingestion continues. A ping
+        # applied after the switch may be both in the snapshot and in the new
+        # segment; restore() skips it by sequence.
+        with self.system.state_lock:
+            self.sequence += 1
+            sequence = self.sequence
+            self.journal.close()
+            self.journal = PingJournal(self.journal_path(sequence), self.fsync)
+            self.last_snapshot = time.monotonic()
+        vehicles = self.system.vehicle_copies()
+        with self.system.state_lock:
+            archive = list(self.system.lifecycle.archive.values())
+            record_sequence = self.record_sequence
+        header, arrays = capture_state(vehicles, archive)
+        header["sequence"] = sequence
+        header["record_sequence"] = record_sequence
+
+        path = self.snapshot_path(sequence)
+        self.writer = threading.Thread(
+            target=self.write, args=(path, header, arrays, sequence), daemon=True
+        )
+        self.writer.start()
+        if wait:
+            self.writer.join()
+        return path
+
+    def write(self, path, header, arrays, sequence):
+        write_snapshot(path, header, arrays)
+        for older in self.sequences("snapshot"):
+            if older < sequence:
+                self.snapshot_path(older).unlink(missing_ok=True)
+        for older in self.sequences("journal"):
+            if older < sequence:
+                self.journal_path(older).unlink(missing_ok=True)
+
+    def restore(self, system):
+        start = time.perf_counter()
+        snapshot_sequence = 0
+        for sequence in reversed(self.sequences("snapshot")):
+            try:
+                header, arrays = read_snapshot(self.snapshot_path(sequence))
+            except (OSError, ValueError):
+                continue
+            restore_state(system, header, arrays)
+            snapshot_sequence = sequence
+            self.record_sequence = header["record_sequence"]
+            break
+
+        replayed = 0
+        journals = [s for s in self.sequences("journal") if s >= snapshot_sequence]
+        system.journal = None
+        for segment in journals:
+            path = self.journal_path(segment)
+            records, valid_length = PingJournal.read(path)
+            if valid_length < path.stat().st_size:
+                os.truncate(path, valid_length)
+            for kind, sequence, record in records:
+                replayed += self.replay(system, kind, sequence, record)
+
+        self.attach(system, max(journals + [snapshot_sequence]))
+        return {
+            "snapshot": snapshot_sequence,
+            "vehicles": len(system.active_vehicles),
+            "replayed": replayed,
+            "seconds": time.perf_counter() - start,
+        }
+
+    def replay(self, system, kind, sequence, record):
+        # Returns whether the record was applied; records the snapshot
+        # already holds are skipped.
+        self.record_sequence = max(self.record_sequence, sequence)
+        vehicle_id = record[0] if kind == PING else record["vehicle_id"]
+        vehicle = system.active_vehicles.get(vehicle_id)
+        if vehicle is not None and vehicle.get("journal_sequence", 0) >= sequence:
+            return False
+
+        if kind == PING:
+            if "error" in system.update_vehicle_position(*record):
+                return False
+        else:
+            self.replay_plan(system, record)
+        vehicle = system.active_vehicles.get(vehicle_id)
+        if vehicle is not None:
+            vehicle["journal_sequence"] = sequence
+            system.publish(vehicle_id)
+        return True
+
+    def replay_plan(self, system, record):
+        route = record["route"]
+        route["waypoints"] = [tuple(point) for point in route["waypoints"]]
+        system.register_route(
+            record["vehicle_id"],
+            record["start_lat"],
+            record["start_lng"],
+            record["end_lat"],
+            record["end_lng"],
+            pd.Timestamp(record["departure_time"]),
+            route,
+        )
+
+    def close(self):
+        if self.writing():
+            self.writer.join()
+        if self.journal is not None:
+            self.journal.close()
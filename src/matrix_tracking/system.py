@@ -1,24 +1,132 @@
-import pandas as pd
-import haversine as hs
+import threading
+from collections import deque
+from src.lazy import lazy_import
+from src.features import geodesic
+from src.predict.model_store import preload_models
 from .anomaly_detector import AnomalyDetector
+from .concurrency import ShardedLock
+from .geofence import GeofenceEngine
+from .lifecycle import VehicleLifecycleManager
+from .ping_filter import AdaptivePingFilter
 from .trajectory_database import TrajectoryDatabase
 from .routing_engine import routing_engine_calculate_route
 
+pd = lazy_import("pandas")
+
 
 class MatrixTrackingSystem:
-    def __init__(self):
+    ARRIVAL_RADIUS_KM = 0.1
+    MAX_GEOFENCE_EVENTS = 10_000
+    MAX_ALERTS = 10_000
+
+    def __init__(
+        self,
+        preload=False,
+        travel_time_matrix=None,
+        geofence=None,
+        lifecycle=None,
+        fast_distance=False,
+        adaptive=False,
+        ping_filter=None,
+    ):
+        # fast_distance=True switches the per-ping distance checks to the
+        # equirectangular approximation (see src.features.geodesic).
+        # adaptive=True skips the full evaluation of pings that cannot have
+        # changed the vehicle state (see AdaptivePingFilter).
+        self.fast_distance = fast_distance
         self.trajectory_db = TrajectoryDatabase()
-        self.anomaly_detector = AnomalyDetector()
+        self.anomaly_detector = AnomalyDetector(fast_distance=fast_distance)
+        self.travel_time_matrix = travel_time_matrix
+        self.geofence = geofence or GeofenceEngine()
+        self.lifecycle = lifecycle or VehicleLifecycleManager()
+        self.ping_filter = ping_filter or (AdaptivePingFilter() if adaptive else None)
+        if self.ping_filter is not None:
+            self.ping_filter.bind(
+                self.anomaly_detector.max_route_distance, self.ARRIVAL_RADIUS_KM
+            )
         self.active_vehicles = {}
-        self.alerts = []
+        # Recent alerts across the fleet; each vehicle keeps its own list.
+        self.alerts = deque(maxlen=self.MAX_ALERTS)
+        # Most recent events only; consumers call drain_geofence_events().
+        self.geofence_events = deque(maxlen=self.MAX_GEOFENCE_EVENTS)
+        # A ping holds its vehicle's shard lock for the whole update; the
+        # shared registries (active_vehicles membership, lifecycle, geofence
+        # state, alerts, journal) are only touched under state_lock.
+        self.vehicle_locks = ShardedLock()
+        self.state_lock = threading.RLock()
+        # The last complete state of each vehicle, published by publish() for
+        # readers that must not wait on the vehicle's shard lock.
+        self.vehicle_views = {}
+        # Set by SnapshotManager.attach() to journal plans and pings.
+        self.journal = None
+        if preload:
+            self.warm_up()
+
+    def warm_up(self):
+        # Loads the models and runs one prediction so the first real ping does
+        # not pay for unpickling or for importing pandas/scikit-learn.
+        preload_models()
+        self.anomaly_detector.duration_predictor.predict(
+            -122.4194, 37.7749, -122.2727, 37.8716, "2023-05-15 08:30:00"
+        )
 
     def plan_route(
         self, vehicle_id, start_lat, start_lng, end_lat, end_lng, departure_time
     ):
         route = routing_engine_calculate_route(
-            start_lat, start_lng, end_lat, end_lng, departure_time
+            start_lat,
+            start_lng,
+            end_lat,
+            end_lng,
+            departure_time,
+            self.travel_time_matrix,
         )
+        self.register_route(
+            vehicle_id, start_lat, start_lng, end_lat, end_lng, departure_time, route
+        )
+
+        return {
+            "vehicle_id": vehicle_id,
+            "planned_route": route,
+            "expected_duration": route["duration"],
+            "expected_arrival": pd.to_datetime(departure_time)
+            + pd.Timedelta(seconds=route["duration"]),
+        }
 
+    def register_route(
+        self, vehicle_id, start_lat, start_lng, end_lat, end_lng, departure_time, route
+    ):
+        if self.journal is not None:
+            self.journal.maybe_snapshot()
+        with self.vehicle_locks.lock_for(vehicle_id), self.state_lock:
+            sequence = None
+            if self.journal is not None:
+                sequence = self.journal.record_plan(
+                    vehicle_id,
+                    start_lat,
+                    start_lng,
+                    end_lat,
+                    end_lng,
+                    departure_time,
+                    route,
+                )
+            self.add_vehicle(
+                vehicle_id,
+                start_lat,
+                start_lng,
+                end_lat,
+                end_lng,
+                departure_time,
+                route,
+            )
+            if sequence is not None:
+                self.active_vehicles[vehicle_id]["journal_sequence"] = sequence
+            self.publish(vehicle_id)
+
+    def add_vehicle(
+        self, vehicle_id, start_lat, start_lng, end_lat, end_lng, departure_time, route
+    ):
+        departure_time = pd.to_datetime(departure_time)
         self.active_vehicles[vehicle_id] = {
             "vehicle_id": vehicle_id,
             "start_lat": start_lat,
@@ -28,30 +136,102 @@ class MatrixTrackingSystem:
             "departure_time": departure_time,
             "planned_route": route,
             "expected_duration": route["duration"],
-            "expected_arrival": pd.to_datetime(departure_time)
+            "expected_arrival": departure_time
             + pd.Timedelta(seconds=route["duration"]),
             "current_position": (start_lat, start_lng),
             "last_update": departure_time,
             "trajectory": [(start_lat, start_lng)],
-            "timestamps": [pd.to_datetime(departure_time)],
+            "timestamps": [departure_time],
             "status": "planned",
             "alerts": [],
         }
+        self.lifecycle.register(vehicle_id, departure_time)
 
-        return {
-            "vehicle_id": vehicle_id,
-            "planned_route": route,
-            "expected_duration": route["duration"],
-            "expected_arrival": pd.to_datetime(departure_time)
-            + pd.Timedelta(seconds=route["duration"]),
-        }
+    def update_vehicle_positions(self, pings):
+        # Evaluates the geofences for the whole batch in one vectorized pass
+        # before running the per-vehicle updates. Results line up with the
+        # input; unknown vehicles get the usual error dict.
+        known = [ping for ping in pings if ping[0] in self.active_vehicles]
+        if known and self.journal is not None:
+            self.journal.maybe_snapshot()
+        if known:
+            self.check_geofences(*zip(*known))
+        return [
+            self.update_vehicle_position(*ping, check_geofences=False) for ping in pings
+        ]
 
-    def update_vehicle_position(self, vehicle_id, lat, lng, timestamp):
-        if vehicle_id not in self.active_vehicles:
-            return {"error": "Veículo não encontrado"}
+    def drain_geofence_events(self):
+        with self.state_lock:
+            events = list(self.geofence_events)
+            self.geofence_events.clear()
+        return events
+
+    def check_geofences(self, vehicle_ids, lats, lngs, timestamps):
+        if not self.geofence.zones:
+            return []
+
+        with self.state_lock:
+            events = self.geofence.evaluate(vehicle_ids, lats, lngs, timestamps)
+            for event in events:
+                self.geofence_events.append(event)
+                vehicle = self.active_vehicles.get(event["vehicle_id"])
+                if (
+                    vehicle is not None
+                    and event["kind"] == "restricted"
+                    and event["event"] == "enter"
+                ):
+                    alert = {
+                        "vehicle_id": event["vehicle_id"],
+                        "timestamp": event["timestamp"],
+                        "type": "restricted_zone",
+                        "details": f"Entrada em zona restrita: {event['zone_id']}.",
+                    }
+                    vehicle["alerts"].append(alert)
+                    self.alerts.append(alert)
+        return events
+
+    def update_vehicle_position(
+        self, vehicle_id, lat, lng, timestamp, check_geofences=True
+    ):
+        # The snapshot check runs before any lock is held so that a capture
+        # never waits on the caller's own shard.
+        if self.journal is not None:
+            self.journal.maybe_snapshot()
+        with self.vehicle_locks.lock_for(vehicle_id):
+            result = self.apply_position(
+                vehicle_id, lat, lng, timestamp, check_geofences
+            )
+            self.publish(vehicle_id)
+            return result
+
+    def apply_position(self, vehicle_id, lat, lng, timestamp, check_geofences):
+        vehicle = self.active_vehicles.get(vehicle_id)
+        if vehicle is None:
+            return self.archived_status(vehicle_id)
 
-        vehicle = self.active_vehicles[vehicle_id]
         timestamp = pd.to_datetime(timestamp)
+        with self.state_lock:
+            if self.journal is not None:
+                # The last journal record applied to the vehicle, so a replay
+                # can skip what a snapshot already holds.
+                vehicle["journal_sequence"] = self.journal.record_ping(
+                    vehicle_id, lat, lng, timestamp
+                )
+            self.lifecycle.touch(vehicle_id, timestamp)
+        self.evict_stale_vehicles()
+        if check_geofences:
+            self.check_geofences([vehicle_id], [lat], [lng], [timestamp])
+
+        if self.ping_filter is not None and not self.ping_filter.should_evaluate(
+            vehicle, lat, lng, timestamp
+        ):
+            vehicle["current_position"] = (lat, lng)
+            vehicle["last_update"] = timestamp
+            return {
+                **vehicle["last_evaluation"]["result"],
+                "current_position": (lat, lng),
+                "evaluated": False,
+            }
 
         previous_position = vehicle["current_position"]
         vehicle["current_position"] = (lat, lng)
@@ -60,10 +240,10 @@ class MatrixTrackingSystem:
         vehicle["last_update"] = timestamp
         vehicle["status"] = "active"
 
-        distance_to_end = hs.haversine(
-            (lat, lng), (vehicle["end_lat"], vehicle["end_lng"])
+        distance_to_end = geodesic.point_distance(
+            (lat, lng), (vehicle["end_lat"], vehicle["end_lng"]), self.fast_distance
         )
-        if distance_to_end < 0.1:
+        if distance_to_end < self.ARRIVAL_RADIUS_KM:
             vehicle["status"] = "completed"
 
             actual_duration = (
@@ -82,12 +262,13 @@ class MatrixTrackingSystem:
             )
 
             metadata = {
+                "status": "completed",
                 "planned_duration": vehicle["expected_duration"],
                 "actual_duration": actual_duration,
                 "deviation": time_result["deviation"],
             }
 
-            self.trajectory_db.store_trajectory(
+            trajectory_id = self.trajectory_db.store_trajectory(
                 vehicle_id, vehicle["trajectory"], vehicle["timestamps"], metadata
             )
 
@@ -99,7 +280,10 @@ class MatrixTrackingSystem:
                     "details": f"Anomalia de tempo detectada: {time_result['anomaly_type']}. Desvio de {100*time_result['deviation']:.1f}%",
                 }
                 vehicle["alerts"].append(alert)
-                self.alerts.append(alert)
+                with self.state_lock:
+                    self.alerts.append(alert)
+
+            self.archive_vehicle(vehicle_id, "completed", trajectory_id, time_result)
 
             return {
                 "status": "completed",
@@ -122,9 +306,10 @@ class MatrixTrackingSystem:
                 "details": f"Desvio de rota detectado. Distância: {route_result['distance_from_route']:.2f} km da rota planejada.",
             }
             vehicle["alerts"].append(alert)
-            self.alerts.append(alert)
+            with self.state_lock:
+                self.alerts.append(alert)
 
-        total_distance = hs.haversine(
+        total_distance = geodesic.point_distance(
             (vehicle["start_lat"], vehicle["start_lng"]),
             (vehicle["end_lat"], vehicle["end_lng"]),
         )
@@ -152,9 +337,10 @@ class MatrixTrackingSystem:
                 "details": f"Previsão de atraso: {delay/60:.1f} minutos. Nova ETA: {new_eta.strftime('%H:%M:%S')}",
             }
             vehicle["alerts"].append(alert)
-            self.alerts.append(alert)
+            with self.state_lock:
+                self.alerts.append(alert)
 
-        return {
+        result = {
             "status": "active",
             "progress": progress * 100,
             "distance_to_end": distance_to_end,
@@ -166,14 +352,140 @@ class MatrixTrackingSystem:
             "route_deviation": route_result["is_anomaly"],
             "alerts": vehicle["alerts"],
         }
+        if self.ping_filter is not None:
+            result["evaluated"] = True
+            self.ping_filter.record(
+                vehicle,
+                lat,
+                lng,
+                timestamp,
+                route_result["distance_from_route"],
+                distance_to_end,
+                result,
+            )
+        return result
+
+    def archive_vehicle(self, vehicle_id, reason, trajectory_id=None, time_result=None):
+        with self.state_lock:
+            vehicle = self.active_vehicles.pop(vehicle_id)
+            self.vehicle_views.pop(vehicle_id, None)
+            self.geofence.forget(vehicle_id)
+            return self.lifecycle.archive_vehicle(
+                vehicle, reason, trajectory_id, time_result
+            )
+
+    def evict_stale_vehicles(self, now=None):
+        # Vehicles without a ping for longer than the lifecycle TTL leave the
+        # active map; only their summary is kept.
+        with self.state_lock:
+            candidates = self.lifecycle.stale_vehicles(now)
+
+        stale = []
+        for vehicle_id in candidates:
+            # The caller may already hold another shard, so never block here:
+            # a vehicle whose shard is busy goes back to the lifecycle and is
+            # retried on a later ping.
+            lock = self.vehicle_locks.lock_for(vehicle_id)
+            if not lock.acquire(blocking=False):
+                with self.state_lock:
+                    vehicle = self.active_vehicles.get(vehicle_id)
+                    if (
+                        vehicle is not None
+                        and vehicle_id not in self.lifecycle.last_seen
+                    ):
+                        self.lifecycle.mark(vehicle_id, vehicle["last_update"])
+                continue
+            try:
+                with self.state_lock:
+                    # A ping that arrived in between touched the vehicle again.
+                    vehicle = self.active_vehicles.get(vehicle_id)
+                    if vehicle is None or vehicle_id in self.lifecycle.last_seen:
+                        continue
+                    vehicle["status"] = "stale"
+                # The partial trip is kept in the trajectory store; the shard
+                # lock keeps new pings for this vehicle out until it is archived.
+                trajectory_id = self.trajectory_db.store_trajectory(
+                    vehicle_id,
+                    vehicle["trajectory"],
+                    vehicle["timestamps"],
+                    {
+                        "status": "stale",
+                        "planned_duration": vehicle["expected_duration"],
+                    },
+                )
+                self.archive_vehicle(vehicle_id, "stale", trajectory_id)
+                stale.append(vehicle_id)
+            finally:
+                lock.release()
+        return stale
+
+    def archived_status(self, vehicle_id):
+        # Pings for an archived vehicle say why it left tracking; a stale one
+        # can be planned again with plan_route/register_route.
+        with self.state_lock:
+            summary = self.lifecycle.lookup(vehicle_id)
+        if summary is None:
+            return {"error": "Veículo não encontrado"}
+        if summary["archived_reason"] == "stale":
+            error = "Veículo arquivado por inatividade"
+        else:
+            error = "Veículo já concluiu a viagem"
+        return {
+            "error": error,
+            "status": summary["status"],
+            "archived_reason": summary["archived_reason"],
+            "trajectory_id": summary["trajectory_id"],
+        }
+
+    def publish(self, vehicle_id):
+        # Called under the vehicle's shard lock once an update is complete.
+        # Trajectory, timestamps and alerts only ever grow, so the view keeps
+        # their lengths instead of copying them and readers slice the lists.
+        vehicle = self.active_vehicles.get(vehicle_id)
+        if vehicle is None:
+            return
+        fields = {}
+        lists = {}
+        for key, value in vehicle.items():
+            if isinstance(value, list):
+                lists[key] = (value, len(value))
+            else:
+                fields[key] = value
+        self.vehicle_views[vehicle_id] = (fields, lists)
+
+    def vehicle_copies(self):
+        # Passing every shard lock once lets the updates already running
+        # publish their views; the views are then copied without any lock,
+        # so a snapshot pauses each shard only for that handoff.
+        for lock in self.vehicle_locks.locks:
+            with lock:
+                pass
+        return [read_view(view) for view in self.vehicle_views.copy().values()]
 
     def get_vehicle_status(self, vehicle_id=None):
         if vehicle_id:
-            if vehicle_id in self.active_vehicles:
-                return self.active_vehicles[vehicle_id]
+            view = self.vehicle_views.get(vehicle_id)
+            if view is not None:
+                return read_view(view)
+            with self.state_lock:
+                summary = self.lifecycle.lookup(vehicle_id)
+            if summary is not None:
+                return summary
             return {"error": "Veículo não encontrado"}
         else:
+            views = self.vehicle_views.copy()
             return {
-                vid: {"status": v["status"], "position": v["current_position"]}
-                for vid, v in self.active_vehicles.items()
+                vid: {
+                    "status": fields["status"],
+                    "position": fields["current_position"],
+                }
+                for vid, (fields, _) in views.items()
             }
+
+
+def read_view(view):
+    fields, lists = view
+    return {
+        **fields,
+        **{key: values[:length] for key, (values, length) in lists.items()},
+    }
@@ -1,19 +1,45 @@
+import threading
+from itertools import count
 from uuid import uuid4
 import warnings
-import pandas as pd
-import haversine as hs
+from src.lazy import lazy_import
+from src.features import geodesic
+from src.pipeline.memory_report import memory_report
+from .segment_index import SegmentIndex
+
+np = lazy_import("numpy")
+pd = lazy_import("pandas")
+pandas_types = lazy_import("pandas.api.types")
 
 warnings.filterwarnings("ignore")
 
 
 class TrajectoryDatabase:
-    def __init__(self):
+    FLOAT32_COLUMNS = [
+        "start_lat",
+        "start_lng",
+        "end_lat",
+        "end_lng",
+        "distance",
+        "speed",
+    ]
+
+    def __init__(self, lean=False):
+        # lean=True uses integer trajectory ids, a categorical vehicle_id and
+        # float32 coordinates and segment metrics.
+        self.lean = lean
+        self.trajectory_ids = count()
         self.trajectories = pd.DataFrame()
         self.segments = pd.DataFrame()
         self.trip_stats = pd.DataFrame()
+        self.segment_index = SegmentIndex()
+        self.heatmaps = []
+        # Writers rebuild the frames and swap them in under the lock; readers
+        # take the current references via frames() and never mutate them.
+        self.lock = threading.RLock()
 
     def store_trajectory(self, vehicle_id, points, timestamps, metadata=None):
-        trajectory_id = uuid4()
+        trajectory_id = next(self.trajectory_ids) if self.lean else uuid4()
         trip_data = {
             "trajectory_id": trajectory_id,
             "vehicle_id": vehicle_id,
@@ -31,59 +57,153 @@ class TrajectoryDatabase:
             for key, value in metadata.items():
                 trip_data[key] = value
 
-        self.trajectories = pd.concat(
-            [self.trajectories, pd.DataFrame([trip_data])], ignore_index=True
-        )
+        trip = self.trip_frame(trip_data)
+        segments = None
+        if len(points) > 1:
+            segments = self.build_segments(trajectory_id, points, timestamps)
 
-        for i in range(len(points) - 1):
-            segment = {
-                "trajectory_id": trajectory_id,
-                "segment_id": i,
-                "start_lat": points[i][0],
-                "start_lng": points[i][1],
-                "end_lat": points[i + 1][0],
-                "end_lng": points[i + 1][1],
-                "start_time": timestamps[i],
-                "end_time": timestamps[i + 1],
-                "duration": (timestamps[i + 1] - timestamps[i]).total_seconds(),
-                "distance": hs.haversine(points[i], points[i + 1]),
-            }
-
-            if segment["duration"] > 0:
-                segment["speed"] = (segment["distance"] / segment["duration"]) * 3600
-            else:
-                segment["speed"] = 0
-
-            self.segments = pd.concat(
-                [self.segments, pd.DataFrame([segment])], ignore_index=True
-            )
+        with self.lock:
+            self.trajectories = self.append_rows(self.trajectories, trip)
+            if segments is not None:
+                self.segments = self.append_rows(self.segments, segments)
+                self.segment_index.add(segments)
+                for heatmap in self.heatmaps:
+                    heatmap.update(segments)
 
         return trajectory_id
 
+    def build_segments(self, trajectory_id, points, timestamps):
+        coordinates = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        times = pd.DatetimeIndex(timestamps)
+        durations = np.asarray((times[1:] - times[:-1]).total_seconds())
+        distances = geodesic.path_lengths(coordinates)
+        speeds = np.divide(
+            distances * 3600,
+            durations,
+            out=np.zeros_like(distances),
+            where=durations > 0,
+        )
+        columns = {
+            "trajectory_id": trajectory_id,
+            "segment_id": np.arange(len(coordinates) - 1),
+            "start_lat": coordinates[:-1, 0],
+            "start_lng": coordinates[:-1, 1],
+            "end_lat": coordinates[1:, 0],
+            "end_lng": coordinates[1:, 1],
+            "start_time": times[:-1],
+            "end_time": times[1:],
+            "duration": durations,
+            "distance": distances,
+            "speed": speeds,
+        }
+        if self.lean:
+            columns["trajectory_id"] = np.full(
+                len(coordinates) - 1, trajectory_id, dtype=np.uint32
+            )
+            columns["segment_id"] = columns["segment_id"].astype(np.uint32)
+            for column in self.FLOAT32_COLUMNS:
+                columns[column] = columns[column].astype(np.float32)
+        return pd.DataFrame(columns)
+
+    def trip_frame(self, trip_data):
+        # Lean rows are built directly in their final dtypes, so appending
+        # them never re-casts the stored frame.
+        columns = {key: [value] for key, value in trip_data.items()}
+        if self.lean:
+            columns["trajectory_id"] = np.array(columns["trajectory_id"], np.uint32)
+            for column in self.FLOAT32_COLUMNS:
+                if column in columns:
+                    columns[column] = np.array(columns[column], np.float32)
+        return pd.DataFrame(columns)
+
+    def append_rows(self, df, rows):
+        if not self.lean or "vehicle_id" not in rows:
+            return pd.concat([df, rows], ignore_index=True) if len(df) else rows
+        if len(df) == 0:
+            return rows.assign(vehicle_id=pd.Categorical(rows["vehicle_id"]))
+
+        # A known vehicle reuses the stored categories, so the concat keeps
+        # the categorical. A new one merges the codes with union_categoricals
+        # instead of letting the concat fall back to object dtype.
+        stored = df["vehicle_id"].dtype
+        codes = stored.categories.get_indexer(rows["vehicle_id"])
+        if (codes >= 0).all():
+            rows = rows.assign(
+                vehicle_id=pd.Categorical.from_codes(codes, dtype=stored)
+            )
+            return pd.concat([df, rows], ignore_index=True)
+
+        try:
+            vehicle_ids = pandas_types.union_categoricals(
+                [df["vehicle_id"], pd.Categorical(rows["vehicle_id"])],
+                ignore_order=True,
+            )
+        except TypeError:
+            # Mixed id types (e.g. int and str) cannot share categories dtype.
+            vehicle_ids = pd.Categorical(
+                list(df["vehicle_id"]) + list(rows["vehicle_id"])
+            )
+        combined = pd.concat(
+            [df.drop(columns="vehicle_id"), rows.drop(columns="vehicle_id")],
+            ignore_index=True,
+        )
+        combined.insert(df.columns.get_loc("vehicle_id"), "vehicle_id", vehicle_ids)
+        return combined
+
+    def frames(self):
+        with self.lock:
+            return self.trajectories, self.segments
+
+    def compact(self):
+        with self.lock:
+            self.trajectories = self.compact_frame(self.trajectories)
+            self.segments = self.compact_frame(self.segments)
+
+    def compact_frame(self, df):
+        if len(df) == 0:
+            return df
+        df = df.copy()
+        if "vehicle_id" in df:
+            df["vehicle_id"] = df["vehicle_id"].astype("category")
+        if "trajectory_id" in df and df["trajectory_id"].dtype != object:
+            df["trajectory_id"] = pd.to_numeric(
+                df["trajectory_id"], downcast="unsigned"
+            )
+        if "segment_id" in df:
+            df["segment_id"] = pd.to_numeric(df["segment_id"], downcast="unsigned")
+        columns = [column for column in self.FLOAT32_COLUMNS if column in df]
+        df[columns] = df[columns].astype("float32")
+        return df
+
+    def memory_report(self):
+        trajectories, segments = self.frames()
+        return {
+            "trajectories": memory_report(trajectories),
+            "segments": memory_report(segments),
+        }
+
     def query_similar_trips(
         self, start_lat, start_lng, end_lat, end_lng, time_of_day=None, limit=5
     ):
-        if len(self.trajectories) == 0:
+        trajectories = self.trajectories
+        if len(trajectories) == 0:
             return pd.DataFrame()
 
-        self.trajectories["start_distance"] = self.trajectories.apply(
-            lambda row: hs.haversine(
-                (row["start_lat"], row["start_lng"]), (start_lat, start_lng)
-            ),
-            axis=1,
+        start_distance = geodesic.one_to_many(
+            (start_lat, start_lng),
+            trajectories["start_lat"].values,
+            trajectories["start_lng"].values,
         )
-
-        self.trajectories["end_distance"] = self.trajectories.apply(
-            lambda row: hs.haversine(
-                (row["end_lat"], row["end_lng"]), (end_lat, end_lng)
-            ),
-            axis=1,
+        end_distance = geodesic.one_to_many(
+            (end_lat, end_lng),
+            trajectories["end_lat"].values,
+            trajectories["end_lng"].values,
         )
 
-        similar_trips = self.trajectories[
-            (self.trajectories["start_distance"] < 1)
-            & (self.trajectories["end_distance"] < 1)
-        ].copy()
+        mask = (start_distance < 1) & (end_distance < 1)
+        similar_trips = trajectories[mask].assign(
+            start_distance=start_distance[mask], end_distance=end_distance[mask]
+        )
 
         if time_of_day and len(similar_trips) > 0:
             similar_trips["hour_diff"] = similar_trips["start_time"].apply(
@@ -102,18 +222,32 @@ class TrajectoryDatabase:
         else:
             return pd.DataFrame()
 
+    def query_segments(self, bbox=None, start=None, end=None, hours=None):
+        # The index merges pending segments on read, so queries hold the lock.
+        with self.lock:
+            return self.segment_index.query(bbox, start, end, hours)
+
+    def average_speed(self, bbox=None, start=None, end=None, hours=None):
+        with self.lock:
+            return self.segment_index.average_speed(bbox, start, end, hours)
+
+    def register_heatmap(self, heatmap):
+        # The heatmap is filled with the stored segments once and then kept
+        # up to date as new trajectories arrive.
+        with self.lock:
+            heatmap.update(self.segments)
+            self.heatmaps.append(heatmap)
+        return heatmap
+
     def get_statistics(self):
+        trajectories, segments = self.frames()
         stats = {
-            "total_trajectories": len(self.trajectories),
-            "total_segments": len(self.segments),
+            "total_trajectories": len(trajectories),
+            "total_segments": len(segments),
             "avg_duration": (
-                self.trajectories["duration"].mean()
-                if len(self.trajectories) > 0
-                else 0
-            ),
-            "avg_speed": self.segments["speed"].mean() if len(self.segments) > 0 else 0,
-            "total_distance": (
-                self.segments["distance"].sum() if len(self.segments) > 0 else 0
+                trajectories["duration"].mean() if len(trajectories) > 0 else 0
             ),
+            "avg_speed": segments["speed"].mean() if len(segments) > 0 else 0,
+            "total_distance": (segments["distance"].sum() if len(segments) > 0 else 0),
         }
         return stats
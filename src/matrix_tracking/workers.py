@@ -0,0 +1,66 @@
+import gc
+import multiprocessing
+import subprocess
+import sys
+from pathlib import Path
+from .system import MatrixTrackingSystem
+
+ROOT_DIR = Path(__file__).resolve().parents[2]
+IMPORT_TIME_BUDGET = 0.5
+
+
+def start_forked_workers(target, num_workers, system=None):
+    # The parent loads every model before forking; gc.freeze() moves those
+    # objects out of the collector's reach so the children never touch their
+    # pages and the models stay shared copy-on-write.
+    system = system or MatrixTrackingSystem(preload=True)
+    gc.freeze()
+
+    context = multiprocessing.get_context("fork")
+    workers = [
+        context.Process(target=target, args=(system, worker_id), daemon=True)
+        for worker_id in range(num_workers)
+    ]
+    try:
+        for worker in workers:
+            worker.start()
+    finally:
+        # The children already hold their copy of the frozen pages; the
+        # parent's later allocations go back under the collector.
+        gc.unfreeze()
+    return workers
+
+
+def join_workers(workers, timeout=None):
+    for worker in workers:
+        worker.join(timeout)
+    return [worker.exitcode for worker in workers]
+
+
+def measure_import_time(module="src.matrix_tracking.system") -> float:
+    code = (
+        "import time; start = time.perf_counter(); "
+        f"import {module}; print(time.perf_counter() - start)"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", code],
+        cwd=ROOT_DIR,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return float(result.stdout.strip())
+
+
+def check_import_budget(module="src.matrix_tracking.system", budget=IMPORT_TIME_BUDGET):
+    elapsed = measure_import_time(module)
+    return {"module": module, "seconds": elapsed, "within_budget": elapsed <= budget}
+
+
+if __name__ == "__main__":
+    report = check_import_budget()
+    print(
+        f"Importar {report['module']}: {report['seconds']*1000:.1f} ms "
+        f"(limite {IMPORT_TIME_BUDGET*1000:.0f} ms)"
+    )
+    sys.exit(0 if report["within_budget"] else 1)
@@ -0,0 +1,192 @@
+from __future__ import annotations
+import argparse
+import hashlib
+import json
+import pickle
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from src.lazy import lazy_import
+from src.features import Clustering
+from src.predict import model_store
+from .feature_pipeline import FeaturePipeline
+from .train_pipeline import TrainPipeline
+
+np = lazy_import("numpy")
+pd = lazy_import("pandas")
+joblib = lazy_import("joblib")
+sklearn_ensemble = lazy_import("sklearn.ensemble")
+sklearn_model_selection = lazy_import("sklearn.model_selection")
+
+CACHE_DIR = model_store.PRODUCTION_DIR.parent / "experiments" / "feature_cache"
+# Bump when the feature stages change so stale cached matrices are not reused.
+PIPELINE_VERSION = 2
+
+
+class ExperimentHarness:
+    TARGET = "duration"
+    DROP_COLUMNS = ["row_id", "datetime"]
+    PARAM_GRID = {
+        "n_estimators": [200, 300, 400],
+        "max_depth": [20, 25, None],
+        "min_samples_split": [2, 5],
+    }
+
+    def __init__(
+        self,
+        n_clusters: int = 3,
+        random_state: int = 95,
+        cv: int = 3,
+        test_size: float = 0.2,
+        n_jobs: int = -1,
+        cache_dir=CACHE_DIR,
+    ):
+        self.n_clusters = n_clusters
+        self.random_state = random_state
+        self.cv = cv
+        self.test_size = test_size
+        self.n_jobs = n_jobs
+        self.cache_dir = Path(cache_dir)
+        self.timings = {}
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        yield
+        self.timings[name] = time.perf_counter() - start
+        print(f"{name}: {self.timings[name]:.2f}s")
+
+    def config(self) -> dict:
+        return {
+            "n_clusters": self.n_clusters,
+            "random_state": self.random_state,
+            "test_size": self.test_size,
+            "pipeline_version": PIPELINE_VERSION,
+        }
+
+    def cache_key(self, df: pd.DataFrame) -> str:
+        digest = hashlib.sha256()
+        digest.update(pd.util.hash_pandas_object(df, index=True).values.tobytes())
+        digest.update(",".join(df.columns).encode())
+        digest.update(json.dumps(self.config(), sort_keys=True).encode())
+        return digest.hexdigest()[:20]
+
+    def prepare(self, df: pd.DataFrame) -> tuple:
+        cache_path = self.cache_dir / f"{self.cache_key(df)}.joblib"
+        if cache_path.exists():
+            with self.stage("Carregar features do cache"):
+                cached = joblib.load(cache_path)
+            return cached["features"], cached["kmeans_models"], cached["train_index"]
+
+        # The split is drawn on the raw rows so the clusters only ever see
+        # training trips; validation rows are then featurized with them.
+        train_index, _ = sklearn_model_selection.train_test_split(
+            df.index, test_size=self.test_size, random_state=self.random_state
+        )
+
+        with self.stage("Treinar KMeans"):
+            train_pipeline = TrainPipeline()
+            clean_df = train_pipeline.fix_coordinates(
+                df.loc[train_index].dropna().copy()
+            )
+            clustering = Clustering(self.n_clusters, self.random_state)
+            clustering.define_models(clean_df, None)
+            kmeans_models = clustering.get_models()
+
+        with self.stage("Gerar features"):
+            train_pipeline = TrainPipeline(FeaturePipeline(kmeans_models))
+            features = train_pipeline.fit(df)
+
+        with self.stage("Salvar features no cache"):
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            joblib.dump(
+                {
+                    "features": features,
+                    "kmeans_models": kmeans_models,
+                    "train_index": train_index,
+                },
+                cache_path,
+            )
+        return features, kmeans_models, train_index
+
+    def split(self, features: pd.DataFrame, train_index) -> tuple:
+        X = features.drop(columns=self.DROP_COLUMNS + [self.TARGET], errors="ignore")
+        X = X.sort_index(axis=1)
+        y = features[self.TARGET]
+        is_train = features.index.isin(train_index)
+        return X[is_train], X[~is_train], y[is_train], y[~is_train]
+
+    def search(self, X_train, y_train, param_grid: dict = None):
+        # Folds and grid points run in parallel; each forest stays
+        # single-threaded to avoid oversubscribing the cores.
+        grid_search = sklearn_model_selection.GridSearchCV(
+            estimator=sklearn_ensemble.RandomForestRegressor(
+                random_state=self.random_state, n_jobs=1
+            ),
+            param_grid=param_grid or self.PARAM_GRID,
+            cv=self.cv,
+            scoring="neg_root_mean_squared_error",
+            n_jobs=self.n_jobs,
+        )
+        grid_search.fit(X_train, y_train)
+        return grid_search
+
+    def evaluate(self, model, X_val, y_val) -> float:
+        predictions = model.predict(X_val)
+        return float(np.sqrt(np.mean((y_val.values - predictions) ** 2)))
+
+    def publish(self, model, kmeans_models, output_dir=model_store.PRODUCTION_DIR):
+        output_dir = Path(output_dir)
+        output_dir.mkdir(parents=True, exist_ok=True)
+        with open(output_dir / model_store.DURATION_MODEL, "wb") as f:
+            pickle.dump(model, f)
+        joblib.dump(kmeans_models[0], output_dir / model_store.START_CLUSTER_MODEL)
+        joblib.dump(kmeans_models[1], output_dir / model_store.END_CLUSTER_MODEL)
+        model_store.clear_cache()
+        return output_dir
+
+    def run(self, df: pd.DataFrame, param_grid: dict = None, publish: bool = True):
+        self.timings = {}
+        features, kmeans_models, train_index = self.prepare(df)
+        X_train, X_val, y_train, y_val = self.split(features, train_index)
+
+        with self.stage("Busca de hiperparâmetros"):
+            grid_search = self.search(X_train, y_train, param_grid)
+
+        with self.stage("Avaliação"):
+            rmse = self.evaluate(grid_search.best_estimator_, X_val, y_val)
+
+        report = {
+            "best_params": grid_search.best_params_,
+            "cv_rmse": float(-grid_search.best_score_),
+            "validation_rmse": rmse,
+            "train_rows": len(X_train),
+            "validation_rows": len(X_val),
+            "config": self.config(),
+        }
+
+        if publish:
+            with self.stage("Publicar modelos"):
+                self.publish(grid_search.best_estimator_, kmeans_models)
+
+        report["timings"] = dict(self.timings)
+        return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("data", help="CSV de treino com a coluna duration")
+    parser.add_argument("--n-clusters", type=int, default=3)
+    parser.add_argument("--cv", type=int, default=3)
+    parser.add_argument("--n-jobs", type=int, default=-1)
+    parser.add_argument("--param-grid", type=json.loads, default=None)
+    parser.add_argument("--no-publish", action="store_true")
+    args = parser.parse_args()
+
+    harness = ExperimentHarness(
+        n_clusters=args.n_clusters, cv=args.cv, n_jobs=args.n_jobs
+    )
+    report = harness.run(
+        pd.read_csv(args.data), args.param_grid, publish=not args.no_publish
+    )
+    print(json.dumps(report, indent=2, default=str, ensure_ascii=False))
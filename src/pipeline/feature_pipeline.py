@@ -1,6 +1,6 @@
-import os
-import pandas as pd
-from joblib import load
+from __future__ import annotations
+from src.lazy import lazy_import
+from src.predict.model_store import load_kmeans_models
 from src.features import (
     Clustering,
     DistanceCalculator,
@@ -9,14 +9,22 @@ from src.features import (
     Temporal,
 )
 
+pd = lazy_import("pandas")
+
 
 class FeaturePipeline:
-    def __init__(self):
-        self.clustering = Clustering()
-        self.distance_calculator = DistanceCalculator()
-        self.geographical = Geographical()
-        self.interactions = Interactions()
-        self.temporal = Temporal()
+    COORDINATE_COLUMNS = ["start_lat", "start_lng", "end_lat", "end_lng"]
+
+    def __init__(self, kmeans_models: tuple = None, lean: bool = False):
+        # lean=True emits bool flags, uint8 cluster/calendar fields and
+        # float32 coordinates and deltas.
+        self.kmeans_models = kmeans_models
+        self.lean = lean
+        self.clustering = Clustering(lean=lean)
+        self.distance_calculator = DistanceCalculator(lean=lean)
+        self.geographical = Geographical(lean=lean)
+        self.interactions = Interactions(lean=lean)
+        self.temporal = Temporal(lean=lean)
 
     def fit(self, df: pd.DataFrame) -> pd.DataFrame:
         df_features = df.copy()
@@ -29,16 +37,16 @@ class FeaturePipeline:
         df_features = self.geographical.create(df_features)
         df_features = self.interactions.create(df_features)
         df_features = self.temporal.create(df_features)
+        if self.lean:
+            df_features = self.downcast_coordinates(df_features)
         return df_features
 
+    def downcast_coordinates(self, df: pd.DataFrame) -> pd.DataFrame:
+        # Runs after clustering and distances, which still see float64 input.
+        df[self.COORDINATE_COLUMNS] = df[self.COORDINATE_COLUMNS].astype("float32")
+        return df
+
     def load_kmeas_models(self) -> tuple:
-        root_path = os.path.dirname(
-            os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-        )
-        start_kmeans_path = os.path.join(
-            root_path, "models/production/start_cluster_model.pkl"
-        )
-        end_kmeans_path = os.path.join(
-            root_path, "models/production/end_cluster_model.pkl"
-        )
-        return load(start_kmeans_path), load(end_kmeans_path)
+        if self.kmeans_models is not None:
+            return self.kmeans_models
+        return load_kmeans_models()
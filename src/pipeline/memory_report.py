@@ -0,0 +1,46 @@
+from src.lazy import lazy_import
+from .feature_pipeline import FeaturePipeline
+
+np = lazy_import("numpy")
+pd = lazy_import("pandas")
+
+
+def memory_report(df):
+    usage = df.memory_usage(deep=True, index=False)
+    report = pd.DataFrame(
+        {"dtype": df.dtypes.astype(str), "bytes": usage.astype("int64")}
+    )
+    report.loc["total"] = ["", int(usage.sum())]
+    return report
+
+
+def compare_lean_mode(df, model=None, kmeans_models=None) -> dict:
+    # Runs the full and the lean feature pipelines on the same data and checks
+    # that the duration model gives identical predictions for both.
+    full = FeaturePipeline(kmeans_models).fit(df)
+    lean = FeaturePipeline(kmeans_models, lean=True).fit(df)
+    report = {
+        "full_bytes": int(full.memory_usage(deep=True).sum()),
+        "lean_bytes": int(lean.memory_usage(deep=True).sum()),
+        "columns": memory_report(full).join(
+            memory_report(lean), lsuffix="_full", rsuffix="_lean"
+        ),
+    }
+
+    if model is not None:
+        full_predictions = model.predict(prepare_model_input(full))
+        lean_predictions = model.predict(prepare_model_input(lean))
+        report["max_prediction_diff"] = float(
+            np.max(np.abs(full_predictions - lean_predictions), initial=0.0)
+        )
+        report["predictions_match"] = bool(
+            np.array_equal(full_predictions, lean_predictions)
+        )
+    return report
+
+
+def prepare_model_input(features):
+    features = features.drop(
+        columns=["row_id", "datetime", "duration"], errors="ignore"
+    )
+    return features.sort_index(axis=1)
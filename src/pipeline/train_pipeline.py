@@ -1,11 +1,13 @@
-import pandas as pd
+from src.lazy import lazy_import
 from .feature_pipeline import FeaturePipeline
 
+pd = lazy_import("pandas")
+
 
 class TrainPipeline:
 
-    def __init__(self):
-        self.feature_pipeline = FeaturePipeline()
+    def __init__(self, feature_pipeline=None):
+        self.feature_pipeline = feature_pipeline or FeaturePipeline()
 
     def fit(self, df):
         train_df = df.copy()
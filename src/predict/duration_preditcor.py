@@ -1,14 +1,18 @@
-import os.path
-import pickle
-import pandas as pd
-from pathlib import Path
+from src.lazy import lazy_import
 from src.pipeline import FeaturePipeline
+from src.predict.model_store import load_duration_model
+
+pd = lazy_import("pandas")
 
 
 class DurationPredictor:
 
-    def __init__(self):
-        self.feature_pipeline = FeaturePipeline()
+    INPUT_COLUMNS = ["start_lng", "start_lat", "end_lng", "end_lat", "datetime"]
+
+    def __init__(self, travel_time_matrix=None, lean=False, model_path=None):
+        self.feature_pipeline = FeaturePipeline(lean=lean)
+        self.travel_time_matrix = travel_time_matrix
+        self.model_path = model_path
 
     def predict(self, start_lng, start_lat, end_lng, end_lat, datetime):
         df = pd.DataFrame(
@@ -26,15 +30,23 @@ class DurationPredictor:
 
         return model.predict(df)
 
-    def get_model(self):
-        base_dir = Path(__file__).resolve().parents[2]
-        model_path = os.path.join(
-            base_dir, "models", "production", "ronsomForestRefressor.pkl"
-        )
+    def predict_approximate(self, start_lng, start_lat, end_lng, end_lat, datetime):
+        # Serves the ETA from the precomputed matrix and only runs the model
+        # when the matrix cell has too little support.
+        if self.travel_time_matrix is not None:
+            duration = self.travel_time_matrix.lookup(
+                start_lng, start_lat, end_lng, end_lat, datetime
+            )
+            if duration is not None:
+                return duration
+        return float(self.predict(start_lng, start_lat, end_lng, end_lat, datetime)[0])
+
+    def predict_many(self, df):
+        df = self.prepare_df(df[self.INPUT_COLUMNS])
+        return pd.Series(self.get_model().predict(df), index=df.index)
 
-        with open(model_path, "rb") as f:
-            model = pickle.load(f)
-        return model
+    def get_model(self):
+        return load_duration_model(self.model_path)
 
     def prepare_df(self, df):
         df = self.feature_pipeline.fit(df)
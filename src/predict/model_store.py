@@ -0,0 +1,57 @@
+import pickle
+import threading
+from pathlib import Path
+from src.lazy import lazy_import
+
+joblib = lazy_import("joblib")
+
+PRODUCTION_DIR = Path(__file__).resolve().parents[2] / "models" / "production"
+DURATION_MODEL = "ronsomForestRefressor.pkl"
+START_CLUSTER_MODEL = "start_cluster_model.pkl"
+END_CLUSTER_MODEL = "end_cluster_model.pkl"
+
+_models = {}
+_lock = threading.Lock()
+
+
+def load_model(path, use_joblib: bool = False):
+    # Models are loaded once per process and shared by every predictor, so a
+    # worker forked after preload_models() reuses the parent's pages.
+    key = str(Path(path).resolve())
+    model = _models.get(key)
+    if model is not None:
+        return model
+
+    with _lock:
+        if key not in _models:
+            if use_joblib:
+                _models[key] = joblib.load(key)
+            else:
+                with open(key, "rb") as f:
+                    _models[key] = pickle.load(f)
+        return _models[key]
+
+
+def load_duration_model(path=None):
+    return load_model(path or PRODUCTION_DIR / DURATION_MODEL)
+
+
+def load_kmeans_models() -> tuple:
+    return (
+        load_model(PRODUCTION_DIR / START_CLUSTER_MODEL, use_joblib=True),
+        load_model(PRODUCTION_DIR / END_CLUSTER_MODEL, use_joblib=True),
+    )
+
+
+def preload_models() -> dict:
+    start_kmeans, end_kmeans = load_kmeans_models()
+    return {
+        "duration_model": load_duration_model(),
+        "start_kmeans": start_kmeans,
+        "end_kmeans": end_kmeans,
+    }
+
+
+def clear_cache():
+    with _lock:
+        _models.clear()
@@ -0,0 +1,180 @@
+from __future__ import annotations
+import argparse
+from pathlib import Path
+from src.lazy import lazy_import
+from src.features import geodesic
+from src.predict.model_store import PRODUCTION_DIR, load_kmeans_models
+
+np = lazy_import("numpy")
+pd = lazy_import("pandas")
+
+TRAVEL_TIME_MATRIX = "travel_time_matrix.npz"
+
+
+class TravelTimeMatrix:
+    # Duration means indexed by
+    # [start_cluster, end_cluster, hour_of_week, distance_bin].
+    HOURS_OF_WEEK = 7 * 24
+    DISTANCE_BIN_EDGES = (1.0, 2.0, 5.0, 10.0, 20.0, 50.0)
+    MIN_SUPPORT = 5
+
+    def __init__(
+        self,
+        start_centers,
+        end_centers,
+        durations=None,
+        support=None,
+        distance_bin_edges=DISTANCE_BIN_EDGES,
+        min_support: int = MIN_SUPPORT,
+    ):
+        self.start_centers = np.asarray(start_centers, dtype=np.float64)
+        self.end_centers = np.asarray(end_centers, dtype=np.float64)
+        self.distance_bin_edges = np.asarray(distance_bin_edges, dtype=np.float64)
+        self.min_support = min_support
+
+        shape = self.shape
+        self.durations = (
+            np.zeros(shape, dtype=np.float32) if durations is None else durations
+        )
+        self.support = np.zeros(shape, dtype=np.uint32) if support is None else support
+
+    @property
+    def shape(self) -> tuple:
+        return (
+            len(self.start_centers),
+            len(self.end_centers),
+            self.HOURS_OF_WEEK,
+            len(self.distance_bin_edges) + 1,
+        )
+
+    @classmethod
+    def from_kmeans(cls, kmeans_models=None, **kwargs):
+        start_kmeans, end_kmeans = kmeans_models or load_kmeans_models()
+        return cls(start_kmeans.cluster_centers_, end_kmeans.cluster_centers_, **kwargs)
+
+    @classmethod
+    def from_model(cls, trips: pd.DataFrame, predictor=None, **kwargs):
+        # Bulk-predicts every sample trip with the production model and keeps
+        # the mean prediction per cell.
+        if predictor is None:
+            from src.predict.duration_preditcor import DurationPredictor
+
+            predictor = DurationPredictor()
+        predictions = predictor.predict_many(trips)
+        matrix = cls.from_kmeans(**kwargs)
+        matrix.fit(trips.loc[predictions.index], predictions.values)
+        return matrix
+
+    @classmethod
+    def from_trajectories(cls, trajectories: pd.DataFrame, **kwargs):
+        trips = trajectories.rename(columns={"start_time": "datetime"})
+        if "status" in trips:
+            # Stale partial trips are truncated; their durations would drag
+            # down the means of the short-distance bins.
+            trips = trips[trips["status"] == "completed"]
+        trips = trips[trips["duration"] > 0]
+        matrix = cls.from_kmeans(**kwargs)
+        matrix.fit(trips, trips["duration"].values)
+        return matrix
+
+    def fit(self, trips: pd.DataFrame, durations):
+        flat_index = np.ravel_multi_index(self.cell_indexes(trips), self.shape)
+        size = int(np.prod(self.shape))
+
+        totals = np.bincount(
+            flat_index, weights=np.asarray(durations, dtype=np.float64), minlength=size
+        )
+        counts = np.bincount(flat_index, minlength=size)
+        totals += self.durations.ravel().astype(np.float64) * self.support.ravel()
+        counts += self.support.ravel()
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            means = np.where(counts > 0, totals / counts, 0.0)
+        self.durations = means.astype(np.float32).reshape(self.shape)
+        self.support = counts.astype(np.uint32).reshape(self.shape)
+        return self
+
+    def cell_indexes(self, trips: pd.DataFrame) -> tuple:
+        start_cluster = self.nearest_center(
+            self.start_centers, trips["start_lat"].values, trips["start_lng"].values
+        )
+        end_cluster = self.nearest_center(
+            self.end_centers, trips["end_lat"].values, trips["end_lng"].values
+        )
+        datetimes = pd.to_datetime(trips["datetime"])
+        hour_of_week = datetimes.dt.dayofweek.values * 24 + datetimes.dt.hour.values
+        distance_bin = np.digitize(
+            geodesic.haversine(
+                trips["start_lat"].values,
+                trips["start_lng"].values,
+                trips["end_lat"].values,
+                trips["end_lng"].values,
+            ),
+            self.distance_bin_edges,
+        )
+        return start_cluster, end_cluster, hour_of_week, distance_bin
+
+    def nearest_center(self, centers, lats, lngs):
+        points = np.column_stack([np.atleast_1d(lats), np.atleast_1d(lngs)])
+        squared = ((points[:, None, :] - centers[None, :, :]) ** 2).sum(axis=2)
+        return squared.argmin(axis=1)
+
+    def lookup(self, start_lng, start_lat, end_lng, end_lat, datetime):
+        timestamp = pd.Timestamp(datetime)
+        cell = (
+            self.nearest_center(self.start_centers, start_lat, start_lng)[0],
+            self.nearest_center(self.end_centers, end_lat, end_lng)[0],
+            timestamp.dayofweek * 24 + timestamp.hour,
+            np.digitize(
+                geodesic.haversine(start_lat, start_lng, end_lat, end_lng),
+                self.distance_bin_edges,
+            ),
+        )
+        if self.support[cell] < self.min_support:
+            return None
+        return float(self.durations[cell])
+
+    def lookup_many(self, trips: pd.DataFrame):
+        cell = self.cell_indexes(trips)
+        durations = self.durations[cell].astype(np.float64)
+        durations[self.support[cell] < self.min_support] = np.nan
+        return durations
+
+    def save(self, path=None):
+        path = Path(path or PRODUCTION_DIR / TRAVEL_TIME_MATRIX)
+        np.savez_compressed(
+            path,
+            start_centers=self.start_centers,
+            end_centers=self.end_centers,
+            distance_bin_edges=self.distance_bin_edges,
+            durations=self.durations,
+            support=self.support,
+            min_support=np.array(self.min_support),
+        )
+        return path
+
+    @classmethod
+    def load(cls, path=None):
+        with np.load(path or PRODUCTION_DIR / TRAVEL_TIME_MATRIX) as data:
+            return cls(
+                data["start_centers"],
+                data["end_centers"],
+                durations=data["durations"],
+                support=data["support"],
+                distance_bin_edges=data["distance_bin_edges"],
+                min_support=int(data["min_support"]),
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("trips", help="CSV com start/end lat/lng e datetime")
+    parser.add_argument("--output", default=None)
+    parser.add_argument("--min-support", type=int, default=TravelTimeMatrix.MIN_SUPPORT)
+    args = parser.parse_args()
+
+    trips = pd.read_csv(args.trips).dropna()
+    matrix = TravelTimeMatrix.from_model(trips, min_support=args.min_support)
+    path = matrix.save(args.output)
+    filled = int((matrix.support >= matrix.min_support).sum())
+    print(f"Matriz salva em {path}: {filled}/{matrix.support.size} células com suporte")